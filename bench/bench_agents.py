@@ -0,0 +1,160 @@
+"""
+benchmark of HGCS agents against the in-memory FakeSchedd, no condor daemon needed
+
+Each agent and number of jobs is run in a separate process, for N cycles, reporting jobs/sec per cycle,
+time spent in schedd calls per stage (total over all cycles) and RSS after setup and at peak, e.g.
+    python bench/bench_agents.py --n-jobs 10000,100000,1000000 --cycles 3
+    python bench/bench_agents.py --agents LogRetriever --n-jobs 10000 --files --file-size 65536 --max-workers 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from hgcs import agents, metrics, utils  # noqa: E402
+from hgcs.fake_schedd import FakeSchedd, generate_jobs  # noqa: E402
+
+AGENT_NAME_LIST = ["LogRetriever", "SDFFetcher", "CleanupDelayer", "XJobCleaner"]
+
+
+def get_rss_kb():
+    """
+    get current RSS of the process in kB
+    """
+    with open("/proc/self/status") as _f:
+        for line in _f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def make_agent_jobs(agent_name, n_jobs, base_dir, file_size):
+    """
+    make synthetic jobs matching the requirements of the agent
+    """
+    if agent_name == "CleanupDelayer":
+        job_list = generate_jobs(n_jobs, status_list=(1, 2), sdf=False)
+        for job in job_list:
+            del job["SUBMIT_UserLog"]
+            job["LeaveJobInQueue"] = False
+    elif agent_name == "XJobCleaner":
+        job_list = generate_jobs(n_jobs, status_list=(3,), sdf=False)
+    else:
+        job_list = generate_jobs(n_jobs, base_dir=base_dir, status_list=(4, 3), file_size=file_size, sdf=agent_name == "SDFFetcher")
+    return job_list
+
+
+def run_worker(arguments):
+    """
+    run one agent over synthetic jobs for some cycles, and print results in JSON
+    """
+    base_dir = tempfile.mkdtemp(prefix="hgcs_bench_", dir=arguments.tmp_dir) if arguments.files else None
+    try:
+        job_list = make_agent_jobs(arguments.agent, arguments.n_jobs, base_dir, arguments.file_size)
+        schedd = FakeSchedd(job_list, latency=arguments.latency)
+        if not arguments.governor:
+            # measure the agent itself, not the throttling of the schedd governor
+            utils.schedd_governor.configure(max_concurrency=1024, rate=float("inf"), burst=float("inf"))
+        del job_list
+        agent_params = {"sleep_period": 0}
+        if arguments.agent == "LogRetriever":
+            agent_params["max_workers"] = arguments.max_workers
+            agent_params["retrieve_mode"] = arguments.retrieve_mode
+        elif arguments.agent == "SDFFetcher":
+            agent_params["limit"] = arguments.limit
+        elif arguments.agent == "XJobCleaner":
+            agent_params["grace_period"] = 60
+        agent = getattr(agents, arguments.agent)(**agent_params)
+        agent.logger.setLevel(logging.CRITICAL)
+        rss_setup_kb = get_rss_kb()
+        agent.initialize()
+        cycle_list = []
+        for i_cycle in range(arguments.cycles):
+            t_start = time.monotonic()
+            n_jobs = agent.run_cycle(schedd)
+            t_spent = time.monotonic() - t_start
+            cycle_list.append({"cycle": i_cycle, "seconds": round(t_spent, 4), "jobs": n_jobs, "jobs_per_sec": round(n_jobs / t_spent, 1) if t_spent else None})
+        stage_dict = {}
+        for call in ("query", "edit", "act"):
+            value = metrics.registry.get("hgcs_schedd_call_seconds", agent=arguments.agent, call=call, schedd=utils.schedd_governor.name)
+            if value is not None:
+                stage_dict[call] = {"calls": value[1], "seconds": round(value[0], 4)}
+        result = {
+            "agent": arguments.agent,
+            "n_jobs": arguments.n_jobs,
+            "cycles": cycle_list,
+            "stages": stage_dict,
+            "rss_setup_mb": round(rss_setup_kb / 1024, 1),
+            "rss_peak_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+        print(json.dumps(result))
+    finally:
+        if base_dir is not None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def main():
+    """
+    main function
+    """
+    oparser = argparse.ArgumentParser(prog="bench_agents", add_help=True)
+    oparser.add_argument("--agents", default=",".join(AGENT_NAME_LIST), help="comma-separated agents to benchmark")
+    oparser.add_argument("--n-jobs", default="10000", help="comma-separated numbers of synthetic jobs")
+    oparser.add_argument("--cycles", type=int, default=3, help="number of cycles to run each agent")
+    oparser.add_argument("--latency", type=float, default=0.0, help="artificial latency in seconds of each schedd call")
+    oparser.add_argument("--files", action="store_true", help="make real files of jobs for LogRetriever and SDFFetcher")
+    oparser.add_argument("--file-size", type=int, default=0, help="size in bytes of each err/out/log file")
+    oparser.add_argument("--tmp-dir", default=None, help="directory to make files in")
+    oparser.add_argument("--max-workers", type=int, default=1, help="max_workers of LogRetriever")
+    oparser.add_argument("--retrieve-mode", default="copy", help="retrieve_mode of LogRetriever")
+    oparser.add_argument("--limit", type=int, default=6000, help="limit of SDFFetcher")
+    oparser.add_argument("--governor", action="store_true", help="keep default limits of the schedd governor")
+    oparser.add_argument("--json", action="store_true", help="print results in JSON lines")
+    oparser.add_argument("--agent", help=argparse.SUPPRESS)
+    oparser.add_argument("--n-jobs-worker", type=int, dest="n_jobs_worker", help=argparse.SUPPRESS)
+    arguments = oparser.parse_args()
+    if arguments.agent:
+        # worker process
+        arguments.n_jobs = arguments.n_jobs_worker
+        run_worker(arguments)
+        return
+    common_args = ["--cycles", str(arguments.cycles), "--latency", str(arguments.latency), "--file-size", str(arguments.file_size)]
+    common_args += ["--max-workers", str(arguments.max_workers), "--retrieve-mode", arguments.retrieve_mode, "--limit", str(arguments.limit)]
+    if arguments.files:
+        common_args.append("--files")
+    if arguments.governor:
+        common_args.append("--governor")
+    if arguments.tmp_dir:
+        common_args += ["--tmp-dir", arguments.tmp_dir]
+    if not arguments.json:
+        print(f"{'agent':<16} {'jobs':>9} {'cycle':>5} {'seconds':>9} {'jobs/s':>10} {'query s':>9} {'edit s':>9} {'act s':>9} {'RSS MB':>8} {'peak MB':>8}")
+    for agent_name in arguments.agents.split(","):
+        for n_jobs in [int(x) for x in arguments.n_jobs.split(",")]:
+            cmd = [sys.executable, os.path.abspath(__file__), "--agent", agent_name, "--n-jobs-worker", str(n_jobs)] + common_args
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            if arguments.json:
+                print(json.dumps(result))
+                continue
+            stages = result["stages"]
+            for cycle in result["cycles"]:
+                print(
+                    f"{agent_name:<16} {n_jobs:>9} {cycle['cycle']:>5} {cycle['seconds']:>9.3f} {cycle['jobs_per_sec'] or 0:>10.1f} "
+                    f"{stages.get('query', {}).get('seconds', 0):>9.3f} {stages.get('edit', {}).get('seconds', 0):>9.3f} "
+                    f"{stages.get('act', {}).get('seconds', 0):>9.3f} {result['rss_setup_mb']:>8.1f} {result['rss_peak_mb']:>8.1f}"
+                )
+
+
+# ===============================================================
+
+if __name__ == "__main__":
+    main()
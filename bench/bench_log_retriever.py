@@ -0,0 +1,90 @@
+"""
+benchmark of LogRetriever copy throughput against the number of copy workers
+
+Run with the directories on the filesystem of interest (e.g. the shared log area), e.g.
+    python bench/bench_log_retriever.py --n-jobs 2000 --workers 1,2,4,8,16 --src-dir /spool/tmp --dest-dir /shared/tmp
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from hgcs.agents import LogRetriever  # noqa: E402
+
+
+def make_jobs(n_jobs, file_size, src_dir, dest_dir):
+    """
+    make synthetic job ads (as dict) with their err/out/log files
+    """
+    job_list = []
+    payload = os.urandom(file_size)
+    for i_job in range(n_jobs):
+        iwd = os.path.join(src_dir, str(i_job))
+        os.makedirs(iwd, exist_ok=True)
+        for name in ("job.err", "job.out", "job.log"):
+            with open(os.path.join(iwd, name), "wb") as _f:
+                _f.write(payload)
+        job_dest_dir = os.path.join(dest_dir, str(i_job))
+        os.makedirs(job_dest_dir, exist_ok=True)
+        job = {
+            "ClusterId": 1,
+            "ProcId": i_job,
+            "JobStatus": 4,
+            "Iwd": iwd,
+            "Err": "job.err",
+            "Out": "job.out",
+            "UserLog": "job.log",
+            "SUBMIT_UserLog": os.path.join(job_dest_dir, "job.log"),
+            "SUBMIT_TransferOutputRemaps": f"job.err={job_dest_dir}/job.err;job.out={job_dest_dir}/job.out",
+        }
+        job_list.append(job)
+    return job_list
+
+
+def main():
+    """
+    main function
+    """
+    oparser = argparse.ArgumentParser(prog="bench_log_retriever", add_help=True)
+    oparser.add_argument("--n-jobs", type=int, default=1000, help="number of synthetic jobs")
+    oparser.add_argument("--file-size", type=int, default=256 * 1024, help="size in bytes of each err/out/log file")
+    oparser.add_argument("--workers", default="1,2,4,8,16", help="comma-separated numbers of copy workers to try")
+    oparser.add_argument("--src-dir", default=None, help="directory to put synthetic source files in")
+    oparser.add_argument("--dest-dir", default=None, help="directory to copy to")
+    arguments = oparser.parse_args()
+    src_root = tempfile.mkdtemp(prefix="hgcs_bench_src_", dir=arguments.src_dir)
+    dest_root = tempfile.mkdtemp(prefix="hgcs_bench_dest_", dir=arguments.dest_dir)
+    try:
+        job_list = make_jobs(arguments.n_jobs, arguments.file_size, src_root, dest_root)
+        agent = LogRetriever(sleep_period=0)
+        print(f"{'workers':>8} {'seconds':>10} {'jobs/s':>10} {'MB/s':>10}")
+        for n_workers in [int(x) for x in arguments.workers.split(",")]:
+            for job in job_list:
+                for key in ("Err", "Out", "UserLog"):
+                    try:
+                        os.remove(os.path.join(os.path.dirname(job["SUBMIT_UserLog"]), job[key]))
+                    except FileNotFoundError:
+                        pass
+            executor = ThreadPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+            t_start = time.monotonic()
+            n_ok = sum(1 for _, ret_val in agent.retrieve_via_system(job_list, executor=executor) if ret_val)
+            t_spent = time.monotonic() - t_start
+            if executor is not None:
+                executor.shutdown()
+            n_bytes = n_ok * 3 * arguments.file_size
+            print(f"{n_workers:>8} {t_spent:>10.3f} {n_ok / t_spent:>10.1f} {n_bytes / t_spent / 1e6:>10.1f}")
+    finally:
+        shutil.rmtree(src_root, ignore_errors=True)
+        shutil.rmtree(dest_root, ignore_errors=True)
+
+
+# ===============================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+benchmark of per-record overhead in the calling thread of the logging pipeline of HGCS, e.g.
+    python bench/bench_logging.py --records 100000 --threads 4 --log-file /tmp/bench_hgcs.log
+
+Compared are the legacy setup (handler emit wrapped to make a formatter for each record, synchronous write)
+and the current setup (records enqueued to a QueueListener with precompiled formatters), in plain and JSON formats
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from hgcs import utils  # noqa: E402
+
+
+def setup_legacy_logger(logger, pid=None, colored=True, to_file=None):
+    """
+    setup_logger of older HGCS, for comparison
+    """
+    if to_file is not None:
+        hdlr = logging.FileHandler(to_file)
+        colored = False
+    else:
+        hdlr = logging.StreamHandler()
+
+    def emit_decorator(fn):
+        def func(*args):
+            formatter = logging.Formatter(f"[%(asctime)s %(levelname)s]({pid})(%(name)s.%(funcName)s) %(message)s")
+            if colored:
+                levelno = args[0].levelno
+                if levelno >= logging.CRITICAL:
+                    color = "\033[35;1m"
+                elif levelno >= logging.ERROR:
+                    color = "\033[31;1m"
+                elif levelno >= logging.WARNING:
+                    color = "\033[33;1m"
+                elif levelno >= logging.INFO:
+                    color = "\033[32;1m"
+                elif levelno >= logging.DEBUG:
+                    color = "\033[36;1m"
+                else:
+                    color = "\033[0m"
+                formatter = logging.Formatter(f"{color}[%(asctime)s %(levelname)s]({pid})(%(name)s.%(funcName)s) %(message)s\033[0m")
+            hdlr.setFormatter(formatter)
+            return fn(*args)
+
+        return func
+
+    hdlr.emit = emit_decorator(hdlr.emit)
+    logger.addHandler(hdlr)
+    return hdlr
+
+
+def log_records(logger, n_records, result_list):
+    """
+    log records and append the time spent in the caller
+    """
+    t_start = time.perf_counter()
+    for i in range(n_records):
+        logger.debug(f"record {i} of {n_records}")
+    result_list.append(time.perf_counter() - t_start)
+
+
+def run_case(logger, n_records, n_threads):
+    """
+    log records in threads; return caller time per record in microseconds
+    """
+    result_list = []
+    thread_list = [threading.Thread(target=log_records, args=(logger, n_records, result_list)) for _ in range(n_threads)]
+    t_start = time.perf_counter()
+    for thr in thread_list:
+        thr.start()
+    for thr in thread_list:
+        thr.join()
+    t_wall = time.perf_counter() - t_start
+    return sum(result_list) / (n_records * n_threads) * 1e6, t_wall
+
+
+def main():
+    """
+    main function
+    """
+    oparser = argparse.ArgumentParser(prog="bench_logging", add_help=True)
+    oparser.add_argument("--records", type=int, default=50000, help="number of records per thread")
+    oparser.add_argument("--threads", type=int, default=4, help="number of logging threads")
+    oparser.add_argument("--log-file", default=None, help="log file to write; a temporary file if not set")
+    arguments = oparser.parse_args()
+    tmp_dir = None
+    log_file = arguments.log_file
+    if log_file is None:
+        tmp_dir = tempfile.mkdtemp(prefix="hgcs_bench_logging_")
+        log_file = os.path.join(tmp_dir, "bench.log")
+    try:
+        print(f"{'setup':<12} {'us/record (caller)':>20} {'wall s':>9}")
+        # legacy
+        logger = logging.getLogger("bench_legacy")
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        hdlr = setup_legacy_logger(logger, pid="0-0", to_file=log_file)
+        per_record, t_wall = run_case(logger, arguments.records, arguments.threads)
+        hdlr.close()
+        print(f"{'legacy':<12} {per_record:>20.2f} {t_wall:>9.3f}")
+        # queued
+        for json_format in (False, True):
+            name = "queued_json" if json_format else "queued"
+            logger = logging.getLogger(f"bench_{name}")
+            logger.setLevel(logging.DEBUG)
+            logger.propagate = False
+            utils.setup_logger(logger, pid="0-0", to_file=f"{log_file}.{name}", json_format=json_format)
+            per_record, t_wall = run_case(logger, arguments.records, arguments.threads)
+            print(f"{name:<12} {per_record:>20.2f} {t_wall:>9.3f}")
+        # flush queued records before cleanup
+        utils.stop_log_listeners()
+    finally:
+        if tmp_dir is not None:
+            for file_name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, file_name))
+            os.rmdir(tmp_dir)
+
+
+# ===============================================================
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+benchmark of peak memory to query jobs from the in-memory FakeSchedd, by way of getting job IDs, e.g.
+    python bench/bench_query_memory.py --n-jobs 1000000
+
+Each mode runs in a separate process; the peak RSS above the RSS after setup is reported:
+    full       list of full ads (no projection), as CleanupDelayer did
+    projected  list of ads with ClusterId and ProcId only
+    records    JobRecord converted from a list of projected ads, consuming the list (htcondor version 2)
+    stream     JobRecord converted from ads streamed by xquery (htcondor version 1)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+
+from hgcs.fake_schedd import FakeSchedd, generate_jobs  # noqa: E402
+from hgcs.utils import MINIMAL_PROJECTION, iter_job_records  # noqa: E402
+
+MODE_LIST = ["full", "projected", "records", "stream"]
+
+
+def get_rss_kb():
+    """
+    get current RSS of the process in kB
+    """
+    with open("/proc/self/status") as _f:
+        for line in _f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+class PeakSampler(threading.Thread):
+    """
+    sample RSS of the process periodically to get the peak
+    """
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.peak_kb = get_rss_kb()
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.peak_kb = max(self.peak_kb, get_rss_kb())
+            time.sleep(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        self.peak_kb = max(self.peak_kb, get_rss_kb())
+
+
+def get_job_ids(schedd, mode):
+    """
+    get number of job IDs (ClusterId.ProcId) of all jobs in the mode
+    """
+    job_id_set = set()
+    if mode == "full":
+        for job in schedd.query(constraint="true"):
+            job_id_set.add(f"{job.get('ClusterId')}.{job.get('ProcId')}")
+    elif mode == "projected":
+        for job in schedd.query(constraint="true", projection=MINIMAL_PROJECTION):
+            job_id_set.add(f"{job.get('ClusterId')}.{job.get('ProcId')}")
+    elif mode == "records":
+        for record in iter_job_records(schedd.query(constraint="true", projection=MINIMAL_PROJECTION), MINIMAL_PROJECTION):
+            job_id_set.add(record.packed_id)
+    elif mode == "stream":
+        for record in iter_job_records(schedd.xquery("true", MINIMAL_PROJECTION), MINIMAL_PROJECTION):
+            job_id_set.add(record.packed_id)
+    return len(job_id_set)
+
+
+def run_worker(arguments):
+    """
+    run one mode and print results in JSON
+    """
+    schedd = FakeSchedd(generate_jobs(arguments.n_jobs, status_list=(4,), sdf=True))
+    rss_setup_kb = get_rss_kb()
+    sampler = PeakSampler()
+    sampler.start()
+    t_start = time.monotonic()
+    n_jobs = get_job_ids(schedd, arguments.mode)
+    t_spent = time.monotonic() - t_start
+    sampler.stop()
+    result = {
+        "mode": arguments.mode,
+        "n_jobs": n_jobs,
+        "seconds": round(t_spent, 2),
+        "rss_setup_mb": round(rss_setup_kb / 1024, 1),
+        "peak_above_setup_mb": round((sampler.peak_kb - rss_setup_kb) / 1024, 1),
+    }
+    print(json.dumps(result))
+
+
+def main():
+    """
+    main function
+    """
+    oparser = argparse.ArgumentParser(prog="bench_query_memory", add_help=True)
+    oparser.add_argument("--n-jobs", type=int, default=1000000, help="number of synthetic jobs in the queue")
+    oparser.add_argument("--modes", default=",".join(MODE_LIST), help="comma-separated modes to run")
+    oparser.add_argument("--json", action="store_true", help="print results in JSON lines")
+    oparser.add_argument("--mode", help=argparse.SUPPRESS)
+    arguments = oparser.parse_args()
+    if arguments.mode:
+        # worker process
+        run_worker(arguments)
+        return
+    if not arguments.json:
+        print(f"{'mode':<10} {'jobs':>9} {'seconds':>9} {'setup MB':>9} {'peak above setup MB':>20}")
+    for mode in arguments.modes.split(","):
+        cmd = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--n-jobs", str(arguments.n_jobs)]
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        if arguments.json:
+            print(json.dumps(result))
+            continue
+        print(f"{mode:<10} {result['n_jobs']:>9} {result['seconds']:>9.2f} {result['rss_setup_mb']:>9.1f} {result['peak_above_setup_mb']:>20.1f}")
+
+
+# ===============================================================
+
+if __name__ == "__main__":
+    main()
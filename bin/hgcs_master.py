@@ -6,10 +6,14 @@ import argparse
 import inspect
 import logging
 import os
+import signal
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from hgcs import agents  # noqa: E402
 from hgcs import hgcs_config  # noqa: E402
+from hgcs import metrics  # noqa: E402
 from hgcs import utils  # noqa: E402
 
 # # Get main directory path
@@ -44,6 +48,7 @@ def main():
     log_file = "/tmp/hgcs.log"
     log_level = "DEBUG"
     logger_format_colored = True
+    log_json = False
     # load config
     try:
         config = hgcs_config.ConfigClass(config_file_path)
@@ -57,43 +62,139 @@ def main():
     try:
         master_section = getattr(config, "Master")
     except AttributeError:
-        pass
+        master_section = None
     else:
         if getattr(master_section, "log_file", False):
             log_file = getattr(master_section, "log_file")
             logger_format_colored = False
         if getattr(master_section, "log_level", False):
             log_level = getattr(master_section, "log_level")
+        if getattr(master_section, "log_format", None) == "json":
+            log_json = True
+        utils.set_log_rotation(
+            max_bytes=getattr(master_section, "log_rotate_max_bytes", None) or 0,
+            when=getattr(master_section, "log_rotate_when", None),
+            backup_count=getattr(master_section, "log_rotate_backup_count", None) or 5,
+        )
     # case for logs to foregroud stderr
     if arguments.foregroudlog:
         log_file = None
         logger_format_colored = True
-    # add threads of agents to run
+    # governor of schedd calls of agents, one per schedd
+    governor_param_dict = {
+        "max_concurrency": getattr(master_section, "schedd_max_concurrency", None),
+        "rate": getattr(master_section, "schedd_rate", None),
+        "burst": getattr(master_section, "schedd_burst", None),
+        "failure_threshold": getattr(master_section, "schedd_failure_threshold", None),
+        "backoff_max": getattr(master_section, "schedd_backoff_max", None),
+        "slow_call_threshold": getattr(master_section, "schedd_slow_call_threshold", None),
+    }
+    governor_param_dict = {key: val for key, val in governor_param_dict.items() if val is not None}
+    health_check_period = getattr(master_section, "schedd_health_check_period", None) or 300
+    for common_logger in (utils.schedd_governor.logger, utils.schedd_pool.logger):
+        utils.setup_logger(common_logger, pid=os.getpid(), colored=logger_format_colored, to_file=log_file, json_format=log_json)
+        common_logger.setLevel(utils.LOG_LEVEL_MAP.get(log_level, logging.ERROR))
+    # schedds to serve; the local schedd by default
+    schedd_spec_list = getattr(master_section, "schedds", None)
+    if isinstance(schedd_spec_list, str):
+        schedd_spec_list = [schedd_spec_list]
+    schedd_pool_dict = {}
+    if not schedd_spec_list:
+        utils.schedd_governor.configure(**governor_param_dict)
+        utils.schedd_pool.health_check_period = health_check_period
+        schedd_pool_dict[None] = utils.schedd_pool
+    else:
+        collector = getattr(master_section, "collector", None)
+        for schedd_spec in schedd_spec_list:
+            # each schedd with its own pool and governor, so that a dead schedd does not stall the others
+            governor = utils.ScheddGovernor(name=schedd_spec, logger=utils.schedd_governor.logger, **governor_param_dict)
+            schedd_pool_dict[schedd_spec] = utils.ScheddPool(
+                name=schedd_spec,
+                schedd_factory=utils.make_schedd_factory(schedd_spec, collector=collector),
+                governor=governor,
+                health_check_period=health_check_period,
+                logger=utils.schedd_pool.logger,
+            )
+    # queue snapshot shared by agents of each schedd
+    queue_snapshot_dict = {}
+    if getattr(master_section, "queue_snapshot", False):
+        snapshot_logger = logging.getLogger("QueueSnapshot")
+        utils.setup_logger(snapshot_logger, pid=os.getpid(), colored=logger_format_colored, to_file=log_file, json_format=log_json)
+        snapshot_logger.setLevel(utils.LOG_LEVEL_MAP.get(log_level, logging.ERROR))
+        for schedd_name, pool in schedd_pool_dict.items():
+            queue_snapshot_dict[schedd_name] = utils.QueueSnapshot(
+                period=getattr(master_section, "snapshot_period", 60), governor=pool.governor, logger=snapshot_logger
+            )
+    # add threads of agents to run, for each schedd
     thread_list = []
     for name, class_obj in inspect.getmembers(agents, lambda m: inspect.isclass(m) and m.__module__ == "hgcs.agents"):
         if hasattr(config, name):
             section = getattr(config, name)
-            if getattr(section, "enable", False):
+            if not getattr(section, "enable", False):
+                continue
+            # copy worker pool shared by agents of all schedds
+            copy_executor = None
+            max_workers = getattr(section, "max_workers", None)
+            if len(schedd_pool_dict) > 1 and max_workers and max_workers > 1:
+                copy_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+            for schedd_name, pool in schedd_pool_dict.items():
                 param_dict = {
                     "sleep_period": getattr(section, "sleep_period"),
+                    "min_sleep_period": getattr(section, "min_sleep_period", None),
+                    "max_sleep_period": getattr(section, "max_sleep_period", None),
                     "flush_period": getattr(section, "flush_period", None),
                     "grace_period": getattr(section, "grace_period", None),
                     "limit": getattr(section, "limit", None),
+                    "max_workers": getattr(section, "max_workers", None),
+                    "retrieve_mode": getattr(section, "retrieve_mode", None),
+                    "compress": getattr(section, "compress", None),
+                    "max_log_size": getattr(section, "max_log_size", None),
+                    "sync_running": getattr(section, "sync_running", None),
+                    "handled_index_file": getattr(section, "handled_index_file", None),
+                    "discovery_mode": getattr(section, "discovery_mode", None),
+                    "event_log_file": getattr(section, "event_log_file", None),
+                    "reconcile_period": getattr(section, "reconcile_period", None),
+                    "schedd_name": schedd_name,
+                    "schedd_pool": pool,
+                    "queue_snapshot": queue_snapshot_dict.get(schedd_name),
                     "logger_format_colored": logger_format_colored,
                     "log_level": log_level,
                     "log_file": log_file,
+                    "log_json": log_json,
                 }
+                if copy_executor is not None:
+                    param_dict["copy_executor"] = copy_executor
                 agent_instance = class_obj(**param_dict)
                 thread_list.append(agent_instance)
     # master log
     main_logger = logging.getLogger("hgcs_main")
-    utils.setup_logger(main_logger, pid=os.getpid(), colored=logger_format_colored, to_file=log_file)
+    utils.setup_logger(main_logger, pid=os.getpid(), colored=logger_format_colored, to_file=log_file, json_format=log_json)
+    main_logger.setLevel(utils.LOG_LEVEL_MAP.get(log_level, logging.ERROR))
     main_logger.info("This is HGCS")
+    # metrics
+    if getattr(master_section, "metrics_port", None):
+        metrics_address = getattr(master_section, "metrics_address", None) or ""
+        metrics.start_http_server(master_section.metrics_port, address=metrics_address)
+        main_logger.info(f"Serve metrics on {metrics_address}:{master_section.metrics_port}")
+    if getattr(master_section, "metrics_textfile", None):
+        metrics.start_textfile_writer(master_section.metrics_textfile, period=getattr(master_section, "metrics_textfile_period", None) or 60)
+        main_logger.info(f"Write metrics to {master_section.metrics_textfile}")
+    # reopen log files on SIGHUP, e.g. from logrotate, without restarting agents
+    # the handler only sets a flag, as it may run while the main thread holds any lock
+    signal_flag_dict = {"reopen": False}
+    signal.signal(signal.SIGHUP, lambda signum, frame: signal_flag_dict.update(reopen=True))
     # run threads
     for thr in thread_list:
-        print(f"Start thread of agent {thr.__class__.__name__}")
-        main_logger.info(f"Start thread of agent {thr.__class__.__name__}")
+        print(f"Start thread of agent {thr.agent_name}")
+        main_logger.info(f"Start thread of agent {thr.agent_name}")
         thr.start()
+    # wait for threads in main thread, where signals are handled
+    while any(thr.is_alive() for thr in thread_list):
+        time.sleep(1)
+        if signal_flag_dict["reopen"]:
+            signal_flag_dict["reopen"] = False
+            n_reopened = utils.reopen_log_files()
+            main_logger.info(f"Reopened {n_reopened} log files on SIGHUP")
 
 
 # ===============================================================
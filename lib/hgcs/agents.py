@@ -4,11 +4,12 @@ agents of HGCS
 
 # import sys
 import errno
+import functools
 import os
 import re
-import shutil
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     # try to import htcondor version 2 for htcondor version >= 25
@@ -16,7 +17,21 @@ try:
 except ImportError:
     import htcondor
 
-from hgcs.utils import MySchedd, ThreadBase, global_lock  # noqa: E402
+from hgcs.utils import (  # noqa: E402
+    COMPRESS_SUFFIX_MAP,
+    MINIMAL_PROJECTION,
+    PRIORITY_HIGH,
+    ContentCache,
+    DirStatCache,
+    ThreadBase,
+    append_file,
+    compress_file,
+    copy_file,
+    copy_file_truncated,
+    link_or_copy,
+    make_job_id_constraint,
+    write_file,
+)
 
 # ===============================================================
 
@@ -58,93 +73,249 @@ class LogRetriever(ThreadBase):
         "UserLog",
         "SUBMIT_UserLog",
         "SUBMIT_TransferOutputRemaps",
+        "hgcsLogRetrieved",
     ]
 
-    requirements = "isString(SUBMIT_UserLog) " "&& LeaveJobInQueue isnt false " "&& ( JobStatus == 4 " "|| JobStatus == 3 ) "
+    # jobs marked with hgcsLogRetrieved are excluded by the schedd, even if the edit of LeaveJobInQueue fails
+    requirements = "isString(SUBMIT_UserLog) " "&& LeaveJobInQueue isnt false " "&& hgcsLogRetrieved isnt true " "&& ( JobStatus == 4 " "|| JobStatus == 3 ) "
 
-    def __init__(self, flush_period=86400, retrieve_mode="copy", **kwarg):
+    # modes to retrieve logs from the spool on the same host
+    system_retrieve_modes = ("copy", "reflink", "hardlink", "symlink")
+
+    # running jobs to sync logs of
+    running_requirements = "isString(SUBMIT_UserLog) " "&& JobStatus == 2 "
+
+    # jobs marked but not yet released
+    release_requirements = "hgcsLogRetrieved =?= true " "&& LeaveJobInQueue isnt false "
+
+    discovery_event_types = [htcondor.JobEventType.JOB_TERMINATED, htcondor.JobEventType.JOB_ABORTED]
+
+    def __init__(
+        self, flush_period=86400, retrieve_mode="copy", max_workers=1, copy_executor=None, compress=None, max_log_size=None, sync_running=False, **kwarg
+    ):
         ThreadBase.__init__(self, **kwarg)
         if flush_period is None:
             self.flush_period = 86400
         else:
             self.flush_period = flush_period
-        self.retrieve_mode = retrieve_mode
-
-    def run(self):
-        self.set_logger()
-        self.logger.info("agent starts")
-        self.logger.debug(f"startTimestamp: {self.start_timestamp}")
-        already_handled_job_id_set = set()
-        last_flush_timestamp = time.time()
-        while True:
-            self.logger.info("run starts")
-            if time.time() > last_flush_timestamp + self.flush_period:
-                last_flush_timestamp = time.time()
-                already_handled_job_id_set = set()
-                self.logger.info("flushed already_handled_job_id_set")
-            n_try = 999
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd = MySchedd()
-                    break
-                except RuntimeError as exc:
-                    if i_try < n_try:
-                        self.logger.warning(f"{exc} . Retry...")
-                        time.sleep(3)
-                    else:
-                        self.logger.error(f"{exc} . No more retry. Exit")
-                        return
-            n_new_handled_jobs = 0
-            for job in schedd.query(constraint=self.requirements, projection=self.projection):
-                job_id = get_condor_job_id(job)
-                if job_id in already_handled_job_id_set:
-                    continue
-                self.logger.debug(f"to retrieve for condor job {job_id}")
-                if self.retrieve_mode == "symlink":
-                    self.via_system(job, symlink_mode=True)
-                elif self.retrieve_mode == "copy":
-                    ret_val = self.via_system(job)
-                    if ret_val:
-                        already_handled_job_id_set.add(job_id)
-                        n_new_handled_jobs += 1
-                elif self.retrieve_mode == "condor":
-                    self.via_condor_retrieve(job)
-            n_try = 3
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd.edit(list(already_handled_job_id_set), "LeaveJobInQueue", "false")
-                except RuntimeError:
-                    if i_try < n_try:
-                        self.logger.warning(f"failed to edit job {job_id} . Retry: {i_try}")
-                        time.sleep(1)
-                    else:
-                        self.logger.warning(f"failed to edit job {job_id} . Skipped...")
-                else:
-                    already_handled_job_id_set.clear()
-                    break
-            self.logger.info(f"run ends; handled {n_new_handled_jobs} jobs")
-            time.sleep(self.sleep_period)
+        self.retrieve_mode = retrieve_mode or "copy"
+        if max_workers is None:
+            self.max_workers = 1
+        else:
+            self.max_workers = max(1, max_workers)
+        # copy worker pool shared with agents of other schedds, if any
+        self.copy_executor = copy_executor
+        # metadata of files, made again every cycle
+        self.dir_stat_cache = DirStatCache()
+        # job ID: (time synced, {destination path: (inode of source, offset synced up to)})
+        self.sync_offset_dict = {}
+        # compression method of err and out; True for zstd if available else gzip
+        if compress is True:
+            compress = "zstd" if "zstd" in COMPRESS_SUFFIX_MAP else "gzip"
+        if compress and compress not in COMPRESS_SUFFIX_MAP:
+            self.logger.warning(f"compression {compress} not available; use gzip")
+            compress = "gzip"
+        self.compress = compress or None
+        if self.compress and self.retrieve_mode in ("condor", "symlink"):
+            self.logger.warning(f"compress not applied in retrieve_mode {self.retrieve_mode}")
+            self.compress = None
+        # cap in bytes of err and out; only the head and the tail of larger ones are copied
+        self.max_log_size = max_log_size or None
+        # append new bytes of logs of running jobs every cycle, so that the final copy only appends the tail
+        self.sync_running = bool(sync_running)
+        if self.sync_running and self.retrieve_mode not in ("copy", "reflink"):
+            self.logger.warning(f"sync_running not applied in retrieve_mode {self.retrieve_mode}")
+            self.sync_running = False
+
+    def initialize(self):
+        self.register_query(self.requirements, self.projection)
+        if self.sync_running:
+            self.register_query(self.running_requirements, self.projection, key="running")
+        self.already_handled_job_id_set = self.load_handled_index(self.flush_period)
+        self.pending_job_id_set = set()
+        self.executor = self.copy_executor
+        if self.executor is not None:
+            self.logger.debug("use shared copy worker pool")
+        elif self.max_workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.agent_name)
+            self.logger.debug(f"copy worker pool with {self.max_workers} workers")
+
+    def run_cycle(self, schedd):
+        self.expire_handled_jobs(self.already_handled_job_id_set, self.flush_period)
+        new_handled_job_id_list = []
+        to_retrieve_job_list = []
+        queried_job_id_set = set()
+        discovered_job_id_dict = self.discover_jobs(self.discovery_event_types)
+        if discovered_job_id_dict is None:
+            # full scan
+            self.pending_job_id_set.clear()
+            jobs_iter = self.query_jobs(schedd, self.requirements, self.projection)
+        else:
+            # only jobs with new events or not yet handled since discovered
+            self.pending_job_id_set.update(discovered_job_id_dict)
+            if self.pending_job_id_set:
+                requirements = f"( {self.requirements}) && {make_job_id_constraint(self.pending_job_id_set)}"
+                jobs_iter = self.query_jobs(schedd, requirements, self.projection)
+            else:
+                jobs_iter = []
+        for job in jobs_iter:
+            job_id = get_condor_job_id(job)
+            queried_job_id_set.add(job_id)
+            if job_id in self.already_handled_job_id_set:
+                continue
+            self.logger.debug(f"to retrieve for condor job {job_id}")
+            if self.retrieve_mode in self.system_retrieve_modes or self.retrieve_mode == "condor":
+                to_retrieve_job_list.append(job)
+        # metadata of files in this cycle
+        self.dir_stat_cache = DirStatCache()
+        if self.retrieve_mode == "condor":
+            ret_iter = self.retrieve_via_condor(schedd, to_retrieve_job_list, executor=self.executor)
+        else:
+            ret_iter = self.retrieve_via_system(to_retrieve_job_list, mode=self.retrieve_mode, executor=self.executor)
+        for job_id, ret_val in ret_iter:
+            # symlinks are not marked as handled
+            if ret_val and self.retrieve_mode != "symlink":
+                self.already_handled_job_id_set.add(job_id)
+                new_handled_job_id_list.append(job_id)
+        self.count_dir_stat(self.dir_stat_cache)
+        n_new_handled_jobs = len(new_handled_job_id_list)
+        self.update_handled_index(add=new_handled_job_id_list)
+        if discovered_job_id_dict is not None:
+            # keep discovered jobs still matching but not handled to retry next cycle
+            self.pending_job_id_set = {job_id for job_id in queried_job_id_set if job_id not in self.already_handled_job_id_set}
+        # mark handled jobs so that the schedd excludes them from next queries; failed ones are kept in already_handled_job_id_set to mark again next cycle,
+        # except bad ones (e.g. gone from the queue) which would fail forever
+        marked_job_id_list, failed_job_id_list = self.batch_editor.edit(schedd, self.already_handled_job_id_set, "hgcsLogRetrieved", "true")
+        bad_job_id_list = self.batch_editor.bad_job_id_list
+        if bad_job_id_list:
+            self.logger.warning(f"drop {len(bad_job_id_list)} jobs failed to mark alone")
+        self.already_handled_job_id_set.difference_update(marked_job_id_list)
+        self.already_handled_job_id_set.difference_update(bad_job_id_list)
+        self.update_handled_index(remove=marked_job_id_list + bad_job_id_list)
+        # release all marked jobs in one edit with constraint, including ones failed in previous cycles
+        released = self.release_jobs(schedd)
+        n_synced_jobs = 0
+        if self.sync_running:
+            n_synced_jobs = self.sync_running_jobs(schedd)
+        self.logger.info(
+            f"run ends; handled {n_new_handled_jobs} jobs, marked {len(marked_job_id_list)} jobs, failed to mark {len(failed_job_id_list)} jobs, "
+            f"released marked jobs: {released}, synced running jobs: {n_synced_jobs}"
+        )
+        return len(to_retrieve_job_list)
+
+    def release_jobs(self, schedd):
+        """
+        set LeaveJobInQueue to false for jobs marked with hgcsLogRetrieved; return True if succeeded, False otherwise
+        if compress is set, hgcsLogCompression is set to the compression method (i.e. the suffix added to err and out) before, not to release jobs without it
+        """
+        try:
+            if self.compress:
+                with self.schedd_call("edit"):
+                    schedd.edit(f"( {self.release_requirements}) && isUndefined(hgcsLogCompression) ", "hgcsLogCompression", f'"{self.compress}"')
+            with self.schedd_call("edit"):
+                ret = schedd.edit(self.release_requirements, "LeaveJobInQueue", "false")
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.warning(f"failed to release marked jobs ; retry next cycle: {exc}")
+            return False
+        self.logger.debug(f"released marked jobs: {ret}")
+        return True
+
+    def retrieve_via_system(self, job_list, mode="copy", executor=None):
+        """
+        run via_system for each job, fanned out to the copy worker pool if executor is given
+        yield tuples of condor job ID and return value of via_system
+        """
+        func = functools.partial(self.via_system, mode=mode)
+        if executor is None:
+            ret_iter = map(func, job_list)
+        else:
+            ret_iter = executor.map(func, job_list)
+        for job, ret_val in zip(job_list, ret_iter):
+            yield get_condor_job_id(job), ret_val
 
-    def via_system(self, job, symlink_mode=False):
+    def sync_running_jobs(self, schedd):
         """
-        symlink or copy logs when source and destination are on the same host
+        append new bytes of logs of running jobs to their destinations, fanned out to the copy worker pool if any
+        offsets are kept per destination to be used by the final copy, and forgotten when not synced for flush_period
+        return number of running jobs
+        """
+        now = time.time()
+        try:
+            job_list = list(self.query_jobs(schedd, self.running_requirements, self.projection))
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.warning(f"failed to query running jobs ; sync next cycle: {exc}")
+            return 0
+        if self.executor is None:
+            ret_iter = map(self.sync_via_system, job_list)
+        else:
+            ret_iter = self.executor.map(self.sync_via_system, job_list)
+        for job, offset_dict in zip(job_list, ret_iter):
+            self.sync_offset_dict[get_condor_job_id(job)] = (now, offset_dict)
+        for job_id, (timestamp, _) in list(self.sync_offset_dict.items()):
+            if timestamp < now - self.flush_period:
+                del self.sync_offset_dict[job_id]
+        return len(job_list)
+
+    def get_sync_paths(self, job):
+        """
+        get list of tuples of source and destination paths of logs of the job to sync; err and out only if copied as they are
         """
-        ret_val = True
-        job_id = get_condor_job_id(job)
         src_dir = job.get("Iwd")
+        dest_err, dest_out, dest_log = self.get_dest_paths(job)
+        path_list = [(job.get("UserLog"), dest_log)]
+        if not self.compress and not self.max_log_size:
+            path_list += [(job.get("Err"), dest_err), (job.get("Out"), dest_out)]
+        return [(os.path.join(src_dir, name), dest_path) for name, dest_path in path_list if name and dest_path]
+
+    def sync_via_system(self, job):
+        """
+        append bytes of logs of the running job written since the last sync to their destinations
+        return dict of destination path to tuple of inode of the source and offset synced up to
+        """
+        job_id = get_condor_job_id(job)
+        old_offset_dict = self.sync_offset_dict.get(job_id, (None, {}))[1]
+        offset_dict = {}
+        for src_path, dest_path in self.get_sync_paths(job):
+            try:
+                src_stat = os.stat(src_path)
+                offset = self.get_synced_offset(src_path, old_offset_dict.get(dest_path))
+                if offset is None:
+                    offset = 0
+                if src_stat.st_size > offset:
+                    n_bytes, method = append_file(src_path, dest_path, offset)
+                    self.count_copy(n_bytes, "sync")
+                    offset += n_bytes
+                offset_dict[dest_path] = (src_stat.st_ino, offset)
+            except FileNotFoundError:
+                continue
+            except OSError as exc:
+                self.logger.warning(f"failed to sync {src_path} of running condor job {job_id} : {exc}")
+        return offset_dict
+
+    def get_synced_offset(self, src_path, synced):
+        """
+        get offset the destination is synced up to from tuple of inode and offset of the last sync,
+        or None if not synced or the source was replaced or truncated since then
+        """
+        if synced is None:
+            return None
+        inode, offset = synced
+        src_stat = os.stat(src_path)
+        if src_stat.st_ino != inode or src_stat.st_size < offset:
+            return None
+        return offset
+
+    def get_dest_paths(self, job):
+        """
+        get destination paths of err, out and log of the job from SUBMIT_TransferOutputRemaps and SUBMIT_UserLog; None if not given
+        """
         src_err_name = job.get("Err")
         src_out_name = job.get("Out")
         src_log_name = job.get("UserLog")
-        src_err = os.path.join(src_dir, src_err_name)
-        src_out = os.path.join(src_dir, src_out_name)
-        src_log = os.path.join(src_dir, src_log_name)
         dest_err = None
         dest_out = None
         dest_log = job.get("SUBMIT_UserLog")
         transfer_remap_list = str(job.get("SUBMIT_TransferOutputRemaps")).split(";")
-        if not dest_log:
-            self.logger.debug(f"{job_id} has no attribute of spool. Skipped...")
-            return True
         for _m in transfer_remap_list:
             match = re.search(r"([a-zA-Z0-9_.\-]+)=([a-zA-Z0-9_.\-/]+)", _m)
             if match:
@@ -156,8 +327,32 @@ class LogRetriever(ThreadBase):
                     dest_out = dest_path
                 elif name == src_err_name:
                     dest_err = dest_path
-        for src_path, dest_path in zip([src_err, src_out, src_log], [dest_err, dest_out, dest_log]):
-            if not os.path.isfile(src_path) or os.path.islink(src_path):
+        return dest_err, dest_out, dest_log
+
+    def via_system(self, job, mode="copy"):
+        """
+        retrieve logs when source and destination are on the same host, by mode:
+        copy (data copied), reflink (clone sharing blocks), hardlink (same inode), or symlink
+        reflink and hardlink fall back to copy on different filesystems or without support of the filesystem
+        err and out are compressed instead, with the suffix of the compression added to their destinations, if compress is set unless symlink
+        err and out larger than max_log_size are copied only in their head and tail unless symlink
+        """
+        ret_val = True
+        job_id = get_condor_job_id(job)
+        src_dir = job.get("Iwd")
+        src_err = os.path.join(src_dir, job.get("Err"))
+        src_out = os.path.join(src_dir, job.get("Out"))
+        src_log = os.path.join(src_dir, job.get("UserLog"))
+        if not job.get("SUBMIT_UserLog"):
+            self.logger.debug(f"{job_id} has no attribute of spool. Skipped...")
+            return True
+        dest_err, dest_out, dest_log = self.get_dest_paths(job)
+        # offsets synced while the job was running
+        synced_offset_dict = self.sync_offset_dict.pop(job_id, (None, {}))[1]
+        dir_stat_cache = self.dir_stat_cache
+        compress = self.compress if mode != "symlink" else None
+        for src_path, dest_path, is_output in zip([src_err, src_out, src_log], [dest_err, dest_out, dest_log], [True, True, False]):
+            if not dir_stat_cache.isregular(src_path):
                 if job.get("JobStatus") != 4:
                     continue
                 ret_val = False
@@ -167,21 +362,42 @@ class LogRetriever(ThreadBase):
                 ret_val = False
                 self.logger.error(f"no destination path for {src_path} . Skipped...")
                 continue
+            if mode == "symlink" and dir_stat_cache.exists(dest_path):
+                self.logger.debug(f"{dest_path} file already exists. Skipped...")
+                continue
             try:
-                if symlink_mode:
+                synced_offset = self.get_synced_offset(src_path, synced_offset_dict.get(dest_path))
+                if mode == "symlink":
                     os.symlink(src_path, dest_path)
-                    if os.path.islink(dest_path):
-                        self.logger.debug(f"{dest_path} symlink made")
-                    else:
-                        ret_val = False
-                        self.logger.error(f"{dest_path} made but not found")
+                    dir_stat_cache.add(dest_path, is_link=True)
+                    self.logger.debug(f"{dest_path} symlink made")
+                elif compress and is_output:
+                    dest_path += COMPRESS_SUFFIX_MAP[compress]
+                    n_bytes_in, n_bytes = compress_file(src_path, dest_path, compress, max_bytes=self.max_log_size)
+                    self.count_copy(n_bytes, compress)
+                    dir_stat_cache.add(dest_path, n_bytes)
+                    self.logger.debug(f"{dest_path} compressed copy made; {n_bytes_in} bytes into {n_bytes} bytes via {compress}")
+                elif self.max_log_size and is_output and dir_stat_cache.getsize(src_path) > self.max_log_size:
+                    n_bytes = copy_file_truncated(src_path, dest_path, self.max_log_size)
+                    self.count_copy(n_bytes, "truncated")
+                    dir_stat_cache.add(dest_path, n_bytes)
+                    self.logger.info(f"{src_path} larger than {self.max_log_size} bytes ; copied only head and tail into {dest_path}")
+                elif synced_offset is not None:
+                    # only the tail written since the last sync
+                    n_bytes, method = append_file(src_path, dest_path, synced_offset)
+                    self.count_copy(n_bytes, "append")
+                    dir_stat_cache.add(dest_path)
+                    self.logger.debug(f"{dest_path} synced; {n_bytes} bytes appended via {method}")
                 else:
-                    shutil.copy(src_path, dest_path)
-                    if os.path.isfile(dest_path):
-                        self.logger.debug(f"{dest_path} copy made")
+                    if mode == "hardlink":
+                        n_bytes, method = link_or_copy(src_path, dest_path)
                     else:
-                        ret_val = False
-                        self.logger.error(f"{dest_path} made but not found")
+                        n_bytes, method = copy_file(src_path, dest_path, reflink=mode == "reflink")
+                    if method != mode and mode in ("hardlink", "reflink"):
+                        self.logger.debug(f"{mode} not possible for {dest_path} ; fell back to {method}")
+                    self.count_copy(n_bytes, method)
+                    dir_stat_cache.add(dest_path, n_bytes)
+                    self.logger.debug(f"{dest_path} copy made; {n_bytes} bytes via {method}")
             except OSError as exc:
                 if exc.errno == errno.EEXIST:
                     self.logger.debug(f"{dest_path} file already exists. Skipped...")
@@ -193,12 +409,59 @@ class LogRetriever(ThreadBase):
                 self.logger.error(exc)
         return ret_val
 
-    def via_condor_retrieve(self, job):
+    def retrieve_via_condor(self, schedd, job_list, executor=None):
         """
-        retrieve logs via condor_retrieve
-        Not implemented yet
+        run via_condor_retrieve for jobs of each cluster, fanned out to the copy worker pool if executor is given,
+        where each worker uses its own schedd handle from the pool
+        yield tuples of condor job ID and whether logs of the job are retrieved
         """
-        pass
+        jobs_by_cluster = {}
+        for job in job_list:
+            jobs_by_cluster.setdefault(job.get("ClusterId"), []).append(job)
+        cluster_job_lists = list(jobs_by_cluster.values())
+        if executor is None:
+            ret_iter = map(functools.partial(self.via_condor_retrieve, schedd=schedd), cluster_job_lists)
+        else:
+            ret_iter = executor.map(self.via_condor_retrieve, cluster_job_lists)
+        for cluster_job_list, ret_val_list in zip(cluster_job_lists, ret_iter):
+            for job, ret_val in zip(cluster_job_list, ret_val_list):
+                yield get_condor_job_id(job), ret_val
+
+    def via_condor_retrieve(self, job_list, schedd=None):
+        """
+        retrieve sandboxes of jobs of one cluster from the schedd in one call, like condor_transfer_data;
+        with the schedd handle of the current thread from the pool unless schedd is given
+        the schedd writes logs to the destinations of SUBMIT_TransferOutputRemaps and SUBMIT_UserLog, which are then checked
+        return list of whether logs of each job are retrieved
+        """
+        job_id_list = [get_condor_job_id(job) for job in job_list]
+        try:
+            if schedd is None:
+                schedd = self.schedd_pool.get()
+            with self.schedd_call("retrieve", check_slow=False):
+                schedd.retrieve(make_job_id_constraint(job_id_list))
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.error(f"failed to retrieve {len(job_id_list)} jobs of cluster {job_list[0].get('ClusterId')} ; retry next cycle: {exc}")
+            return [False] * len(job_list)
+        ret_val_list = []
+        for job in job_list:
+            ret_val_list.append(True)
+            if not job.get("SUBMIT_UserLog"):
+                continue
+            for dest_path in self.get_dest_paths(job):
+                if not dest_path:
+                    continue
+                try:
+                    n_bytes = os.stat(dest_path).st_size
+                except OSError:
+                    # sandboxes of removed jobs can be incomplete
+                    if job.get("JobStatus") == 4:
+                        ret_val_list[-1] = False
+                        self.logger.error(f"{dest_path} not retrieved for condor job {get_condor_job_id(job)}")
+                    continue
+                self.count_copy(n_bytes, "condor_retrieve")
+        self.logger.debug(f"retrieved {len(job_id_list)} jobs of cluster {job_list[0].get('ClusterId')} ; {ret_val_list.count(True)} with all logs found")
+        return ret_val_list
 
 
 class CleanupDelayer(ThreadBase):
@@ -209,45 +472,22 @@ class CleanupDelayer(ThreadBase):
     requirements = "SUBMIT_UserLog is undefined " "&& LeaveJobInQueue is false " "&& ( member(JobStatus, {1,2,5,6,7}) )"
     ad_LeaveJobInQueue_template = "( time() - EnteredCurrentStatus ) < {delay_time} "
 
-    def __init__(self, sleep_period=60, delay_time=7200):
-        ThreadBase.__init__(self)
+    def __init__(self, delay_time=7200, **kwarg):
+        ThreadBase.__init__(self, **kwarg)
         self.delay_time = delay_time
 
-    def run(self):
-        self.set_logger()
-        self.logger.info("agent starts")
-        self.logger.debug(f"startTimestamp: {self.start_timestamp}")
-        while True:
-            self.logger.info("run starts")
-            n_try = 999
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd = MySchedd()
-                    break
-                except RuntimeError as exc:
-                    if i_try < n_try:
-                        self.logger.warning(f"{exc} . Retry...")
-                        time.sleep(3)
-                    else:
-                        self.logger.error(f"{exc} . No more retry. Exit")
-                        return
-            job_id_list = [get_condor_job_id(job) for job in schedd.query(constraint=self.requirements)]
-            n_jobs = len(job_id_list)
-            n_try = 3
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd.edit(job_id_list, "LeaveJobInQueue", self.ad_LeaveJobInQueue_template.format(delay_time=self.delay_time))
-                except RuntimeError:
-                    if i_try < n_try:
-                        self.logger.warning(f"failed to edit {n_jobs} jobs . Retry: {i_try}")
-                        time.sleep(1)
-                    else:
-                        self.logger.warning(f"failed to edit {n_jobs} jobs . Skipped...")
-                else:
-                    self.logger.debug(f"adjusted LeaveJobInQueue of {n_jobs} condor jobs ")
-                    break
-            self.logger.info("run ends")
-            time.sleep(self.sleep_period)
+    def initialize(self):
+        self.register_query(self.requirements, MINIMAL_PROJECTION)
+
+    def run_cycle(self, schedd):
+        job_id_list = [get_condor_job_id(job) for job in self.query_jobs(schedd, self.requirements, MINIMAL_PROJECTION)]
+        n_jobs = len(job_id_list)
+        edited_job_id_list, failed_job_id_list = self.batch_editor.edit(
+            schedd, job_id_list, "LeaveJobInQueue", self.ad_LeaveJobInQueue_template.format(delay_time=self.delay_time)
+        )
+        self.logger.debug(f"adjusted LeaveJobInQueue of {len(edited_job_id_list)} condor jobs ; failed {len(failed_job_id_list)} of {n_jobs} ")
+        self.logger.info("run ends")
+        return n_jobs
 
 
 class SDFFetcher(ThreadBase):
@@ -277,123 +517,186 @@ class SDFFetcher(ThreadBase):
             self.limit = limit
         else:
             self.limit = 6000
-
-    def run(self):
-        self.set_logger()
-        self.logger.info("agent starts")
-        self.logger.debug(f"startTimestamp: {self.start_timestamp}")
-        already_handled_job_id_set = set()
-        last_flush_timestamp = time.time()
-        while True:
-            self.logger.info("run starts")
-            if time.time() > last_flush_timestamp + self.flush_period:
-                last_flush_timestamp = time.time()
-                already_handled_job_id_set = set()
-                self.logger.info("flushed already_handled_job_id_set")
-            n_try = 999
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd = MySchedd()
-                    break
-                except RuntimeError as exc:
-                    if i_try < n_try:
-                        self.logger.warning(f"{exc} . Retry...")
-                        time.sleep(3)
-                    else:
-                        self.logger.error(f"{exc} . No more retry. Exit")
-                        return
-            already_sdf_copied_job_id_set = set()
-            to_skip_sdf_copied_job_id_set = set()
-            n_new_handled_jobs = 0
-            n_new_skipped_jobs = 0
-            try:
-                jobs_iter = schedd.query(constraint=self.requirements, projection=self.projection, limit=self.limit)
-                for job in jobs_iter:
-                    job_id = get_condor_job_id(job)
-                    if job_id in already_handled_job_id_set:
-                        continue
-                    self.logger.debug(f"to copy sdf for condor job {job_id}")
-                    ret_val = self.via_system(job)
+        # recently read submit description files, for sources gone before all jobs are handled
+        self.sdf_cache = ContentCache()
+        # metadata of files, made again every cycle
+        self.dir_stat_cache = DirStatCache()
+
+    def initialize(self):
+        self.register_query(self.requirements, self.projection)
+        self.already_handled_job_id_set = self.load_handled_index(self.flush_period)
+        # range [lower, upper) of ClusterId to query in the current pass over the queue; upper None for no bound
+        self.cluster_range = (0, None)
+
+    def get_range_requirements(self):
+        """
+        get requirements to query only jobs in the range of ClusterId
+        """
+        lower, upper = self.cluster_range
+        requirements = self.requirements
+        if lower:
+            requirements = f"( {requirements}) && ClusterId >= {lower}"
+        if upper is not None:
+            requirements = f"( {requirements}) && ClusterId < {upper}"
+        return requirements
+
+    def move_range(self, n_queried_jobs, n_progressed_jobs, max_cluster_id):
+        """
+        move the range of ClusterId after a cycle: the schedd does not return jobs in order, so a range is left only once fully read,
+        i.e. when fewer jobs than limit are returned; a full range is queried again while jobs get done, otherwise it is narrowed down,
+        and skipped in this pass if a single cluster
+        """
+        lower, upper = self.cluster_range
+        if not (self.limit > 0 and n_queried_jobs >= self.limit):
+            if upper is None:
+                # reached the end of the queue; wrap around
+                self.cluster_range = (0, None)
+            else:
+                self.cluster_range = (upper, None)
+        elif n_progressed_jobs == 0:
+            if upper is None:
+                upper = max_cluster_id + 1
+            if upper - lower > 1:
+                self.cluster_range = (lower, lower + (upper - lower) // 2)
+            else:
+                self.logger.warning(f"skip cluster {lower} in this pass as no job done of {n_queried_jobs} jobs queried")
+                self.cluster_range = (upper, None)
+        if self.cluster_range != (lower, upper):
+            self.logger.debug(f"range of ClusterId moved to {self.cluster_range}")
+
+    def run_cycle(self, schedd):
+        self.expire_handled_jobs(self.already_handled_job_id_set, self.flush_period)
+        already_sdf_copied_job_id_set = set()
+        to_skip_sdf_copied_job_id_set = set()
+        n_new_handled_jobs = 0
+        n_new_skipped_jobs = 0
+        n_queried_jobs = 0
+        n_progressed_jobs = 0
+        max_cluster_id = 0
+        try:
+            # compact records up to limit, not to keep the query open while copying
+            job_list = list(self.query_jobs(schedd, self.get_range_requirements(), self.projection, limit=self.limit))
+            # group jobs by sdfPath to read each source once
+            sdf_job_list_dict = {}
+            for job in job_list:
+                n_queried_jobs += 1
+                max_cluster_id = max(max_cluster_id, int(job.get("ClusterId")))
+                job_id = get_condor_job_id(job)
+                if job_id in self.already_handled_job_id_set:
+                    continue
+                self.logger.debug(f"to copy sdf for condor job {job_id}")
+                sdf_job_list_dict.setdefault(job.get("sdfPath"), []).append(job)
+            n_source_reads = 0
+            # metadata of files in this cycle
+            self.dir_stat_cache = DirStatCache()
+            for src_path, sdf_job_list in sdf_job_list_dict.items():
+                ret_val_dict, n_reads = self.via_system(src_path, sdf_job_list)
+                n_source_reads += n_reads
+                for job_id, ret_val in ret_val_dict.items():
                     if ret_val is True:
                         already_sdf_copied_job_id_set.add(job_id)
                         n_new_handled_jobs += 1
                     elif ret_val is False:
                         to_skip_sdf_copied_job_id_set.add(job_id)
                         n_new_skipped_jobs += 1
-            except RuntimeError as exc:
-                self.logger.error(f"Failed to query jobs. Exit. RuntimeError: {exc} ")
-            else:
-                n_try = 3
-                for i_try in range(1, n_try + 1):
-                    try:
-                        schedd.edit(list(already_sdf_copied_job_id_set), "sdfCopied", "1")
-                    except RuntimeError:
-                        if i_try < n_try:
-                            self.logger.warning(f"failed to edit job {job_id} . Retry: {i_try}")
-                            time.sleep(1)
-                        else:
-                            self.logger.warning(f"failed to edit job {job_id} . Skipped...")
-                    except Exception:
-                        self.logger.error(f"failed to edit job {job_id} with error ; {traceback.format_exc()}")
-                        break
-                    else:
-                        already_handled_job_id_set.update(already_sdf_copied_job_id_set)
-                        already_sdf_copied_job_id_set.clear()
-                        break
-                n_try = 3
-                for i_try in range(1, n_try + 1):
-                    try:
-                        schedd.edit(list(to_skip_sdf_copied_job_id_set), "sdfCopied", "2")
-                    except RuntimeError:
-                        if i_try < n_try:
-                            self.logger.warning(f"failed to edit job {job_id} . Retry: {i_try}")
-                            time.sleep(1)
-                        else:
-                            self.logger.warning(f"failed to edit job {job_id} . Skipped...")
-                    except Exception:
-                        self.logger.error(f"failed to edit job {job_id} with error ; {traceback.format_exc()}")
-                        break
-                    else:
-                        already_handled_job_id_set.update(to_skip_sdf_copied_job_id_set)
-                        to_skip_sdf_copied_job_id_set.clear()
-                        break
-            self.logger.info(f"run ends; handled {n_new_handled_jobs} jobs, skipped {n_new_skipped_jobs} jobs")
-            time.sleep(self.sleep_period)
-
-    def via_system(self, job):
+            self.logger.debug(
+                f"read {n_source_reads} sources for {len(sdf_job_list_dict)} sdfPath of {n_queried_jobs} jobs ; "
+                f"cache hits {self.sdf_cache.n_hits} misses {self.sdf_cache.n_misses} in total"
+            )
+            self.count_dir_stat(self.dir_stat_cache)
+        except RuntimeError as exc:
+            self.logger.error(f"Failed to query jobs. Exit. RuntimeError: {exc} ")
+        else:
+            for job_id_set, ad_value in [(already_sdf_copied_job_id_set, "1"), (to_skip_sdf_copied_job_id_set, "2")]:
+                try:
+                    edited_job_id_list, failed_job_id_list = self.batch_editor.edit(schedd, job_id_set, "sdfCopied", ad_value)
+                except Exception:
+                    self.logger.error(f"failed to edit sdfCopied of {len(job_id_set)} jobs with error ; {traceback.format_exc()}")
+                    continue
+                self.already_handled_job_id_set.update(edited_job_id_list)
+                self.update_handled_index(add=edited_job_id_list)
+                n_progressed_jobs += len(edited_job_id_list)
+            self.move_range(n_queried_jobs, n_progressed_jobs, max_cluster_id)
+        if self.limit > 0 and n_queried_jobs >= self.limit and n_new_handled_jobs + n_new_skipped_jobs > 0:
+            # more jobs may remain beyond the limit; not if none got done, not to query again and again without progress
+            self.has_backlog = True
+        self.logger.info(f"run ends; handled {n_new_handled_jobs} jobs, skipped {n_new_skipped_jobs} jobs")
+        return n_new_handled_jobs + n_new_skipped_jobs
+
+    def get_dest_path(self, job):
         """
-        copy submit description file when source and destination are on the same host
+        get destination path of submit description file of the job, or None if the job has no valid log
         """
-        ret_val = True
-        job_id = get_condor_job_id(job)
-        src_path = job.get("sdfPath")
         dest_log = job.get("SUBMIT_UserLog")
         if not dest_log:
             dest_log = job.get("UserLog")
         if not dest_log:
-            self.logger.debug(f"{job_id} has no valid SUBMIT_UserLog nor UserLog. Skipped...")
-            return True
+            return None
         dest_dir = os.path.dirname(dest_log)
         dest_filename = re.sub(r".log$", ".jdl", os.path.basename(dest_log))
-        dest_path = os.path.normpath(os.path.join(dest_dir, dest_filename))
-        if not os.path.isfile(src_path):
-            ret_val = False
-            self.logger.error(f"{src_path} is not a regular file. Skipped...")
-        if not dest_path:
-            ret_val = False
-            self.logger.error(f"no destination path for {src_path} . Skipped...")
-        if ret_val is True:
-            if os.path.isfile(dest_path):
+        return os.path.normpath(os.path.join(dest_dir, dest_filename))
+
+    def via_system(self, src_path, job_list):
+        """
+        copy submit description file shared by the jobs when source and destination are on the same host
+        the source is read once, or got from cache if gone; other destinations are hardlinked or reflinked to the first one
+        return tuple of dict of job ID to return value (True if done, False to skip, None to retry) and number of source reads
+        """
+        ret_val_dict = {}
+        n_reads = 0
+        dest_list = []
+        dir_stat_cache = self.dir_stat_cache
+        for job in job_list:
+            job_id = get_condor_job_id(job)
+            dest_path = self.get_dest_path(job)
+            if dest_path is None:
+                self.logger.debug(f"{job_id} has no valid SUBMIT_UserLog nor UserLog. Skipped...")
+                ret_val_dict[job_id] = True
+            elif dir_stat_cache.isfile(dest_path):
                 self.logger.debug(f"{dest_path} file already exists. Skipped...")
-                return True
+                ret_val_dict[job_id] = True
+            else:
+                dest_list.append((job_id, dest_path))
+        if not dest_list:
+            return ret_val_dict, n_reads
+        # content of the source, read once if small enough
+        content = None
+        try:
+            if dir_stat_cache.isfile(src_path):
+                if dir_stat_cache.getsize(src_path) <= self.sdf_cache.max_entry_bytes:
+                    with open(src_path, "rb") as _f:
+                        content = _f.read()
+                    n_reads += 1
+                    self.sdf_cache.put(src_path, content)
+            else:
+                content = self.sdf_cache.get(src_path)
+                if content is None:
+                    self.logger.error(f"{src_path} is not a regular file. Skipped...")
+                    ret_val_dict.update((job_id, False) for job_id, _ in dest_list)
+                    return ret_val_dict, n_reads
+                self.logger.debug(f"{src_path} is gone ; use cached content")
+        except OSError as exc:
+            self.logger.error(exc)
+            ret_val_dict.update((job_id, None) for job_id, _ in dest_list)
+            return ret_val_dict, n_reads
+        first_dest_path = None
+        for job_id, dest_path in dest_list:
+            ret_val = True
             try:
-                shutil.copy(src_path, dest_path)
-                if os.path.isfile(dest_path):
-                    os.chmod(dest_path, 0o644)
-                    self.logger.debug(f"{dest_path} copy made")
+                if first_dest_path is not None:
+                    n_bytes, method = link_or_copy(first_dest_path, dest_path)
+                elif content is not None:
+                    n_bytes, method = write_file(dest_path, content), "memory"
                 else:
-                    ret_val = None
-                    self.logger.error(f"{dest_path} made but not found")
+                    # large source copied directly
+                    n_bytes, method = copy_file(src_path, dest_path)
+                    n_reads += 1
+                self.count_copy(n_bytes, method)
+                os.chmod(dest_path, 0o644)
+                dir_stat_cache.add(dest_path, n_bytes)
+                self.logger.debug(f"{dest_path} copy made; {n_bytes} bytes via {method}")
+                if first_dest_path is None:
+                    first_dest_path = dest_path
             except OSError as exc:
                 if exc.errno == errno.EEXIST:
                     self.logger.debug(f"{dest_path} file already exists. Skipped...")
@@ -403,7 +706,8 @@ class SDFFetcher(ThreadBase):
             except Exception as exc:
                 ret_val = None
                 self.logger.error(exc)
-        return ret_val
+            ret_val_dict[job_id] = ret_val
+        return ret_val_dict, n_reads
 
 
 class XJobCleaner(ThreadBase):
@@ -413,6 +717,11 @@ class XJobCleaner(ThreadBase):
 
     requirements_template = "JobStatus =?= 3 " "&& time() - EnteredCurrentStatus >= {grace_period} "
 
+    discovery_event_types = [htcondor.JobEventType.JOB_ABORTED]
+
+    # removing jobs relieves the schedd, so go ahead of bulk work
+    schedd_priority = PRIORITY_HIGH
+
     def __init__(self, grace_period=86400, **kwarg):
         ThreadBase.__init__(self, **kwarg)
         if grace_period is None:
@@ -420,41 +729,45 @@ class XJobCleaner(ThreadBase):
         else:
             self.grace_period = grace_period
 
-    def run(self):
-        self.set_logger()
-        self.logger.info("agent starts")
-        self.logger.debug(f"startTimestamp: {self.start_timestamp}")
-        while True:
-            self.logger.info("run starts")
-            n_try = 999
-            for i_try in range(1, n_try + 1):
-                try:
-                    schedd = MySchedd()
-                    break
-                except RuntimeError as exc:
-                    if i_try < n_try:
-                        self.logger.warning(f"{exc} . Retry...")
-                        time.sleep(3)
-                    else:
-                        self.logger.error(f"{exc} . No more retry. Exit")
-                        return
-            res_str = str(None)
-            try:
-                requirements = self.requirements_template.format(grace_period=int(self.grace_period))
-                jobs_iter = schedd.query(constraint=requirements, projection=["ClusterId", "ProcId"])
-                n_jobs = 0
-                for job in jobs_iter:
-                    job_id = get_condor_job_id(job)
-                    self.logger.debug(f"to remove condor job {job_id}")
-                    n_jobs += 1
-                if n_jobs == 0:
-                    self.logger.info("no job to remove; skipped")
-                else:
-                    self.logger.debug(f"try to remove-x {n_jobs} jobs")
-                    with global_lock:
-                        act_ret = schedd.act(htcondor.JobAction.RemoveX, requirements)
-                    res_str = str(dict(act_ret))
-                    self.logger.info(f"run ends; return: {res_str}")
-            except RuntimeError as exc:
-                self.logger.error(f"Failed to remove-x jobs. Exit. RuntimeError: {exc} ")
-            time.sleep(self.sleep_period)
+    def initialize(self):
+        self.register_query(self.requirements_template.format(grace_period=int(self.grace_period)), MINIMAL_PROJECTION)
+        self.pending_job_id_dict = {}
+
+    def run_cycle(self, schedd):
+        res_str = str(None)
+        n_jobs = 0
+        discovered_job_id_dict = self.discover_jobs(self.discovery_event_types)
+        if discovered_job_id_dict is not None:
+            self.pending_job_id_dict.update(discovered_job_id_dict)
+        # jobs removed longer than grace period ago
+        due_timestamp = time.time() - self.grace_period
+        due_job_id_list = [job_id for job_id, timestamp in self.pending_job_id_dict.items() if timestamp <= due_timestamp]
+        for job_id in due_job_id_list:
+            del self.pending_job_id_dict[job_id]
+        if self.pending_job_id_dict:
+            self.next_due_timestamp = min(self.pending_job_id_dict.values()) + self.grace_period
+        try:
+            requirements = self.requirements_template.format(grace_period=int(self.grace_period))
+            if discovered_job_id_dict is None:
+                # full scan
+                jobs_iter = self.query_jobs(schedd, requirements, MINIMAL_PROJECTION)
+            elif due_job_id_list:
+                requirements = f"( {requirements}) && {make_job_id_constraint(due_job_id_list)}"
+                jobs_iter = self.query_jobs(schedd, requirements, MINIMAL_PROJECTION)
+            else:
+                jobs_iter = []
+            for job in jobs_iter:
+                job_id = get_condor_job_id(job)
+                self.logger.debug(f"to remove condor job {job_id}")
+                n_jobs += 1
+            if n_jobs == 0:
+                self.logger.info("no job to remove; skipped")
+            else:
+                self.logger.debug(f"try to remove-x {n_jobs} jobs")
+                with self.schedd_pool.act_lock, self.schedd_call("act"):
+                    act_ret = schedd.act(htcondor.JobAction.RemoveX, requirements)
+                res_str = str(dict(act_ret))
+                self.logger.info(f"run ends; return: {res_str}")
+        except RuntimeError as exc:
+            self.logger.error(f"Failed to remove-x jobs. Exit. RuntimeError: {exc} ")
+        return n_jobs
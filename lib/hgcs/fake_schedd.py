@@ -0,0 +1,612 @@
+"""
+in-memory stand-in of htcondor Schedd and synthetic job generator, to exercise and benchmark HGCS agents without condor daemons
+"""
+
+import os
+import re
+import shutil
+import threading
+import time
+
+try:
+    # try to import htcondor version 2 for htcondor version >= 25
+    import classad2 as classad
+except ImportError:
+    try:
+        import classad
+    except ImportError:
+        classad = None
+
+# ===============================================================
+
+
+class _Undefined:
+    """
+    UNDEFINED value of ClassAd
+    """
+
+    def __repr__(self):
+        return "undefined"
+
+    def __bool__(self):
+        return False
+
+
+UNDEFINED = _Undefined()
+
+_TOKEN_PATTERN = re.compile(
+    r"""\s*(?:
+    (?P<real>\d+\.\d*(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)
+    |(?P<int>\d+)
+    |(?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<name>[A-Za-z_][A-Za-z0-9_.]*)
+    |(?P<op>=\?=|=!=|==|!=|<=|>=|&&|\|\||[<>!+\-*/%(){},?:])
+    )""",
+    re.VERBOSE,
+)
+
+# binding powers of binary operators
+_BINARY_POWER_MAP = {
+    "||": 10,
+    "&&": 20,
+    "==": 30,
+    "!=": 30,
+    "=?=": 30,
+    "=!=": 30,
+    "is": 30,
+    "isnt": 30,
+    "<": 40,
+    "<=": 40,
+    ">": 40,
+    ">=": 40,
+    "+": 50,
+    "-": 50,
+    "*": 60,
+    "/": 60,
+    "%": 60,
+}
+
+
+def _tokenize(expr_str):
+    """
+    split ClassAd expression into list of tokens (kind, value)
+    """
+    token_list = []
+    pos = 0
+    expr_str = expr_str.rstrip()
+    while pos < len(expr_str):
+        match = _TOKEN_PATTERN.match(expr_str, pos)
+        if not match:
+            raise SyntaxError(f"cannot parse ClassAd expression at: {expr_str[pos:]}")
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "name" and value.lower() in ("is", "isnt"):
+            kind, value = "op", value.lower()
+        token_list.append((kind, value))
+    token_list.append(("end", None))
+    return token_list
+
+
+def _compare(op, left, right):
+    """
+    comparison operators with ClassAd semantics: UNDEFINED if any operand is UNDEFINED, strings case-insensitive
+    """
+    if left is UNDEFINED or right is UNDEFINED:
+        return UNDEFINED
+    if isinstance(left, str) and isinstance(right, str):
+        left, right = left.lower(), right.lower()
+    elif isinstance(left, str) != isinstance(right, str):
+        return UNDEFINED
+    if op == "==":
+        return left == right
+    if op == "!=":
+        return left != right
+    if op == "<":
+        return left < right
+    if op == "<=":
+        return left <= right
+    if op == ">":
+        return left > right
+    return left >= right
+
+
+def _identical(left, right):
+    """
+    =?= (is) of ClassAd: same type and value, strings case-sensitive
+    """
+    if left is UNDEFINED or right is UNDEFINED:
+        return left is right
+    if isinstance(left, bool) != isinstance(right, bool) or isinstance(left, str) != isinstance(right, str):
+        return False
+    return left == right
+
+
+def _arithmetic(op, left, right):
+    if left is UNDEFINED or right is UNDEFINED:
+        return UNDEFINED
+    if op == "+":
+        return left + right
+    if op == "-":
+        return left - right
+    if op == "*":
+        return left * right
+    if op == "%":
+        return left % right
+    if isinstance(left, int) and isinstance(right, int):
+        return int(left / right)
+    return left / right
+
+
+def _not(value):
+    return UNDEFINED if value is UNDEFINED else not value
+
+
+def _negative(value):
+    return UNDEFINED if value is UNDEFINED else -value
+
+
+def _and(left_func, right_func):
+    def func(ad, now):
+        left = left_func(ad, now)
+        if left is False:
+            return False
+        right = right_func(ad, now)
+        if right is False:
+            return False
+        if left is UNDEFINED or right is UNDEFINED:
+            return UNDEFINED
+        return True
+
+    return func
+
+
+def _or(left_func, right_func):
+    def func(ad, now):
+        left = left_func(ad, now)
+        if left is True:
+            return True
+        right = right_func(ad, now)
+        if right is True:
+            return True
+        if left is UNDEFINED or right is UNDEFINED:
+            return UNDEFINED
+        return False
+
+    return func
+
+
+def _member(value, value_list):
+    if value is UNDEFINED:
+        return UNDEFINED
+    for item in value_list:
+        if _compare("==", value, item) is True:
+            return True
+    return False
+
+
+# functions: name in lower case -> function of evaluated arguments
+_FUNCTION_MAP = {
+    "isundefined": lambda x: x is UNDEFINED,
+    "isstring": lambda x: isinstance(x, str),
+    "isinteger": lambda x: isinstance(x, int) and not isinstance(x, bool),
+    "isreal": lambda x: isinstance(x, float),
+    "isboolean": lambda x: isinstance(x, bool),
+    "member": _member,
+    "int": lambda x: UNDEFINED if x is UNDEFINED else int(x),
+    "real": lambda x: UNDEFINED if x is UNDEFINED else float(x),
+    "string": lambda x: UNDEFINED if x is UNDEFINED else str(x),
+    "size": lambda x: UNDEFINED if x is UNDEFINED else len(x),
+}
+
+
+class _Parser:
+    """
+    Pratt parser compiling a ClassAd expression into a python function of (ad, now)
+    ad is a dict with attribute names in lower case
+    """
+
+    def __init__(self, expr_str):
+        self.token_list = _tokenize(expr_str)
+        self.pos = 0
+
+    def peek(self):
+        return self.token_list[self.pos]
+
+    def next(self):
+        token = self.token_list[self.pos]
+        self.pos += 1
+        return token
+
+    def expect(self, value):
+        kind, token_value = self.next()
+        if token_value != value:
+            raise SyntaxError(f"expected {value} but got {token_value}")
+
+    def parse(self):
+        func = self.parse_expression(0)
+        if self.peek()[0] != "end":
+            raise SyntaxError(f"unexpected token {self.peek()[1]}")
+        return func
+
+    def parse_expression(self, min_power):
+        left_func = self.parse_unary()
+        while True:
+            kind, value = self.peek()
+            if kind == "op" and value == "?" and min_power == 0:
+                self.next()
+                then_func = self.parse_expression(0)
+                self.expect(":")
+                else_func = self.parse_expression(0)
+                left_func = self.make_ternary(left_func, then_func, else_func)
+                continue
+            if kind != "op" or value not in _BINARY_POWER_MAP or _BINARY_POWER_MAP[value] <= min_power:
+                return left_func
+            self.next()
+            right_func = self.parse_expression(_BINARY_POWER_MAP[value])
+            left_func = self.make_binary(value, left_func, right_func)
+
+    def parse_unary(self):
+        kind, value = self.peek()
+        if kind == "op" and value in ("!", "-", "+"):
+            self.next()
+            operand_func = self.parse_unary()
+            if value == "!":
+                return lambda ad, now: _not(operand_func(ad, now))
+            if value == "-":
+                return lambda ad, now: _negative(operand_func(ad, now))
+            return operand_func
+        return self.parse_primary()
+
+    def parse_primary(self):
+        kind, value = self.next()
+        if kind == "int":
+            const = int(value)
+            return lambda ad, now: const
+        if kind == "real":
+            const = float(value)
+            return lambda ad, now: const
+        if kind == "string":
+            const = bytes(value[1:-1], "utf-8").decode("unicode_escape")
+            return lambda ad, now: const
+        if kind == "op" and value == "(":
+            func = self.parse_expression(0)
+            self.expect(")")
+            return func
+        if kind == "op" and value == "{":
+            item_func_list = []
+            if self.peek()[1] != "}":
+                while True:
+                    item_func_list.append(self.parse_expression(0))
+                    if self.peek()[1] != ",":
+                        break
+                    self.next()
+            self.expect("}")
+            return lambda ad, now: [item_func(ad, now) for item_func in item_func_list]
+        if kind == "name":
+            lower_name = value.lower()
+            if lower_name == "true":
+                return lambda ad, now: True
+            if lower_name == "false":
+                return lambda ad, now: False
+            if lower_name == "undefined":
+                return lambda ad, now: UNDEFINED
+            if self.peek()[1] == "(":
+                return self.parse_call(lower_name)
+            if lower_name.startswith("my."):
+                lower_name = lower_name[3:]
+            return lambda ad, now: _lookup(ad, lower_name, now)
+        raise SyntaxError(f"unexpected token {value}")
+
+    def parse_call(self, name):
+        self.expect("(")
+        arg_func_list = []
+        if self.peek()[1] != ")":
+            while True:
+                arg_func_list.append(self.parse_expression(0))
+                if self.peek()[1] != ",":
+                    break
+                self.next()
+        self.expect(")")
+        if name == "time":
+            return lambda ad, now: now
+        if name == "ifthenelse":
+            cond_func, then_func, else_func = arg_func_list
+            return self.make_ternary(cond_func, then_func, else_func)
+        if name not in _FUNCTION_MAP:
+            raise SyntaxError(f"unsupported function {name}")
+        function = _FUNCTION_MAP[name]
+        return lambda ad, now: function(*[arg_func(ad, now) for arg_func in arg_func_list])
+
+    @staticmethod
+    def make_ternary(cond_func, then_func, else_func):
+        def func(ad, now):
+            cond = cond_func(ad, now)
+            if cond is UNDEFINED:
+                return UNDEFINED
+            return then_func(ad, now) if cond else else_func(ad, now)
+
+        return func
+
+    @staticmethod
+    def make_binary(op, left_func, right_func):
+        if op == "&&":
+            return _and(left_func, right_func)
+        if op == "||":
+            return _or(left_func, right_func)
+        if op in ("=?=", "is"):
+            return lambda ad, now: _identical(left_func(ad, now), right_func(ad, now))
+        if op in ("=!=", "isnt"):
+            return lambda ad, now: not _identical(left_func(ad, now), right_func(ad, now))
+        if op in ("==", "!=", "<", "<=", ">", ">="):
+            return lambda ad, now: _compare(op, left_func(ad, now), right_func(ad, now))
+        return lambda ad, now: _arithmetic(op, left_func(ad, now), right_func(ad, now))
+
+
+class Expression:
+    """
+    compiled ClassAd expression, for constraints and for attribute values which are not literals
+    """
+
+    def __init__(self, expr_str):
+        self.expr_str = expr_str
+        self.func = _Parser(expr_str).parse()
+
+    def eval(self, ad, now=None):
+        """
+        evaluate the expression in the context of ad (dict with attribute names in lower case)
+        """
+        return self.func(ad, time.time() if now is None else now)
+
+    def __str__(self):
+        return self.expr_str
+
+
+def _lookup(ad, lower_name, now):
+    value = ad.get(lower_name, UNDEFINED)
+    if isinstance(value, Expression):
+        return value.func(ad, now)
+    return value
+
+
+def parse_value(value_str):
+    """
+    parse value of schedd.edit: literal if possible, otherwise expression
+    """
+    expr = Expression(str(value_str))
+    try:
+        value = expr.eval({})
+    except Exception:
+        return expr
+    if value is UNDEFINED and str(value_str).strip().lower() != "undefined":
+        return expr
+    return value
+
+
+# ===============================================================
+
+
+class FakeSchedd:
+    """
+    in-memory stand-in of htcondor Schedd, implementing query, edit and act
+    jobs are kept as dicts with attribute names in lower case
+    in strict mode, edit and act of job IDs not in the queue fail like the schedd does, instead of skipping them
+    """
+
+    def __init__(self, job_list=None, latency=0.0, as_classad=True, strict=False):
+        self.lock = threading.Lock()
+        # job ID -> ad in lower case
+        self.job_dict = {}
+        # lower case -> original case of attribute names
+        self.name_map = {}
+        # artificial latency in seconds per call, to emulate remote schedd
+        self.latency = latency
+        self.as_classad = as_classad and classad is not None
+        self.strict = strict
+        # statistics
+        self.n_calls = {"query": 0, "edit": 0, "act": 0, "retrieve": 0}
+        self.n_ads_returned = 0
+        if job_list:
+            self.submit(job_list)
+
+    def submit(self, job_list):
+        """
+        add jobs (dicts of attributes including ClusterId and ProcId)
+        """
+        with self.lock:
+            for job in job_list:
+                ad = {}
+                for key, value in job.items():
+                    lower_key = key.lower()
+                    self.name_map.setdefault(lower_key, key)
+                    ad[lower_key] = value
+                self.job_dict[f"{ad['clusterid']}.{ad['procid']}"] = ad
+
+    def _iter_matched(self, constraint):
+        if constraint in (None, "", "true", True):
+            yield from self.job_dict.items()
+            return
+        expr = Expression(str(constraint))
+        now = time.time()
+        for job_id, ad in self.job_dict.items():
+            if expr.func(ad, now) is True:
+                yield job_id, ad
+
+    def _export(self, ad, projection):
+        if projection:
+            lower_projection = [name.lower() for name in projection]
+        else:
+            lower_projection = list(ad)
+        job = {}
+        for lower_name in lower_projection:
+            if lower_name in ad:
+                value = ad[lower_name]
+                if isinstance(value, Expression):
+                    value = classad.ExprTree(str(value)) if self.as_classad else str(value)
+                job[self.name_map.get(lower_name, lower_name)] = value
+        if self.as_classad:
+            return classad.ClassAd(job)
+        return job
+
+    def query(self, constraint="true", projection=[], callback=None, limit=-1, opts=None):
+        """
+        return list of jobs matching the constraint, with attributes of projection (all if empty)
+        """
+        self.n_calls["query"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        ret_list = []
+        with self.lock:
+            for job_id, ad in self._iter_matched(constraint):
+                ret_list.append(self._export(ad, projection))
+                if len(ret_list) == limit:
+                    break
+        self.n_ads_returned += len(ret_list)
+        if callback is not None:
+            ret_list = [ret for ret in map(callback, ret_list) if ret is not None]
+        return ret_list
+
+    def xquery(self, requirements="true", projection=[], limit=-1, opts=None):
+        """
+        yield jobs matching the requirements one by one, like xquery of htcondor version 1
+        """
+        self.n_calls["query"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        expr = None if requirements in (None, "", "true", True) else Expression(str(requirements))
+        with self.lock:
+            job_id_list = list(self.job_dict)
+        n_ads = 0
+        for job_id in job_id_list:
+            with self.lock:
+                ad = self.job_dict.get(job_id)
+                if ad is None or (expr is not None and expr.func(ad, time.time()) is not True):
+                    continue
+                job = self._export(ad, projection)
+            self.n_ads_returned += 1
+            yield job
+            n_ads += 1
+            if n_ads == limit:
+                return
+
+    def _resolve_job_spec(self, job_spec):
+        if isinstance(job_spec, (list, tuple, set)):
+            job_id_list = [str(job_id) for job_id in job_spec]
+        elif re.match(r"^\d+\.\d+$", str(job_spec)):
+            job_id_list = [str(job_spec)]
+        else:
+            return [job_id for job_id, _ in self._iter_matched(job_spec)]
+        missing_list = [job_id for job_id in job_id_list if job_id not in self.job_dict]
+        if missing_list and self.strict:
+            raise RuntimeError(f"jobs not found: {' '.join(missing_list[:10])}")
+        return [job_id for job_id in job_id_list if job_id in self.job_dict]
+
+    def edit(self, job_spec, attr, value):
+        """
+        set attribute of jobs of job_spec (list of job IDs, job ID, or constraint) to value (ClassAd expression string)
+        """
+        self.n_calls["edit"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        parsed_value = parse_value(value)
+        lower_attr = attr.lower()
+        with self.lock:
+            self.name_map.setdefault(lower_attr, attr)
+            job_id_list = self._resolve_job_spec(job_spec)
+            for job_id in job_id_list:
+                self.job_dict[job_id][lower_attr] = parsed_value
+        return len(job_id_list)
+
+    def act(self, action, job_spec, reason=None):
+        """
+        act on jobs; Remove sets JobStatus to 3, RemoveX drops jobs from the queue, others are no-op
+        return dict of statistics like htcondor
+        """
+        self.n_calls["act"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        action_name = getattr(action, "name", str(action))
+        with self.lock:
+            job_id_list = self._resolve_job_spec(job_spec)
+            for job_id in job_id_list:
+                if action_name == "RemoveX":
+                    del self.job_dict[job_id]
+                elif action_name == "Remove":
+                    self.job_dict[job_id]["jobstatus"] = 3
+                    self.job_dict[job_id]["enteredcurrentstatus"] = int(time.time())
+        return {"TotalSuccess": len(job_id_list), "TotalError": 0, "TotalNotFound": 0}
+
+    def retrieve(self, job_spec):
+        """
+        transfer sandboxes of jobs of job_spec like condor_transfer_data of spooled jobs:
+        Err, Out and UserLog in Iwd are copied to destinations of SUBMIT_TransferOutputRemaps and SUBMIT_UserLog, missing ones skipped
+        """
+        self.n_calls["retrieve"] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            ad_list = [dict(self.job_dict[job_id]) for job_id in self._resolve_job_spec(job_spec)]
+        for ad in ad_list:
+            remap_dict = {}
+            for remap in str(ad.get("submit_transferoutputremaps", "")).split(";"):
+                if "=" in remap:
+                    name, dest_path = remap.split("=", 1)
+                    remap_dict[name.strip()] = dest_path.strip()
+            if ad.get("submit_userlog"):
+                remap_dict.setdefault(ad.get("userlog"), ad["submit_userlog"])
+            iwd = ad.get("iwd")
+            for name in (ad.get("err"), ad.get("out"), ad.get("userlog")):
+                src_path = os.path.join(iwd, name)
+                if not os.path.isfile(src_path):
+                    continue
+                shutil.copyfile(src_path, os.path.join(iwd, remap_dict.get(name, name)))
+
+
+# ===============================================================
+
+
+def generate_jobs(n_jobs, base_dir=None, procs_per_cluster=100, status_list=(4,), file_size=0, sdf=True, start_cluster_id=1):
+    """
+    generate synthetic job ads like those of Harvester, optionally with their files under base_dir
+    files (err, out and log of file_size bytes, and SDF per cluster) are only made if base_dir is set
+    status_list is cycled through to set JobStatus of jobs
+    return list of job dicts
+    """
+    job_list = []
+    now = int(time.time())
+    payload = os.urandom(file_size) if file_size else b""
+    n_status = len(status_list)
+    for i_job in range(n_jobs):
+        cluster_id = start_cluster_id + i_job // procs_per_cluster
+        proc_id = i_job % procs_per_cluster
+        root_dir = base_dir or "/nonexistent"
+        iwd = os.path.join(root_dir, "spool", str(cluster_id))
+        dest_dir = os.path.join(root_dir, "logs", str(cluster_id))
+        sdf_path = os.path.join(root_dir, "sdf", f"{cluster_id}.sdf")
+        job = {
+            "ClusterId": cluster_id,
+            "ProcId": proc_id,
+            "JobStatus": status_list[i_job % n_status],
+            "EnteredCurrentStatus": now - 3600,
+            "Iwd": iwd,
+            "Err": f"{proc_id}.err",
+            "Out": f"{proc_id}.out",
+            "UserLog": f"{proc_id}.log",
+            "SUBMIT_UserLog": os.path.join(dest_dir, f"{proc_id}.log"),
+            "SUBMIT_TransferOutputRemaps": f"{proc_id}.err={dest_dir}/{proc_id}.err;{proc_id}.out={dest_dir}/{proc_id}.out",
+        }
+        if sdf:
+            job["sdfPath"] = sdf_path
+        job_list.append(job)
+        if base_dir is not None:
+            if proc_id == 0:
+                os.makedirs(iwd, exist_ok=True)
+                os.makedirs(dest_dir, exist_ok=True)
+                if sdf:
+                    os.makedirs(os.path.dirname(sdf_path), exist_ok=True)
+                    with open(sdf_path, "w") as _f:
+                        _f.write(f"executable = runpilot.sh\nqueue {procs_per_cluster}\n")
+            for name in (job["Err"], job["Out"], job["UserLog"]):
+                with open(os.path.join(iwd, name), "wb") as _f:
+                    _f.write(payload)
+    return job_list
@@ -0,0 +1,238 @@
+"""
+metrics of HGCS, exposed in Prometheus text exposition format
+"""
+
+import bisect
+import contextlib
+import http.server
+import logging
+import os
+import threading
+import time
+
+# ===============================================================
+
+# default buckets of latency histograms in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# name: (type, help) of metrics
+METRIC_DESCRIPTION_MAP = {
+    "hgcs_agent_cycles_total": ("counter", "Number of cycles run by the agent"),
+    "hgcs_agent_cycle_errors_total": ("counter", "Number of cycles of the agent ended with an exception"),
+    "hgcs_agent_cycle_seconds": ("histogram", "Duration of cycles of the agent"),
+    "hgcs_agent_cycle_jobs": ("gauge", "Number of jobs processed by the agent in the last cycle"),
+    "hgcs_agent_last_cycle_timestamp_seconds": ("gauge", "Unix time when the last cycle of the agent ended"),
+    "hgcs_agent_sleep_seconds": ("gauge", "Interval chosen by the scheduler before the next cycle of the agent"),
+    "hgcs_schedd_call_seconds": ("histogram", "Duration of schedd calls"),
+    "hgcs_schedd_call_errors_total": ("counter", "Number of failed schedd calls"),
+    "hgcs_schedd_governor_wait_seconds": ("histogram", "Time schedd calls waited for the governor"),
+    "hgcs_schedd_circuit_open": ("gauge", "Whether the circuit breaker of schedd calls is open"),
+    "hgcs_schedd_connections_total": ("counter", "Number of schedd handles made by the pool"),
+    "hgcs_lock_wait_seconds": ("histogram", "Time waited to acquire the lock"),
+    "hgcs_lock_held_seconds": ("histogram", "Time the lock was held"),
+    "hgcs_copy_files_total": ("counter", "Number of files copied"),
+    "hgcs_copy_bytes_total": ("counter", "Number of bytes copied"),
+    "hgcs_dir_scans_total": ("counter", "Number of directories scanned for metadata of files"),
+    "hgcs_stat_calls_avoided_total": ("counter", "Number of metadata syscalls of files avoided by answering from directory scans"),
+}
+
+
+def _escape_label_value(value):
+    """
+    escape label value
+    """
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labels):
+    """
+    format labels of a sample
+    """
+    if not labels:
+        return ""
+    label_str = ",".join(f'{key}="{_escape_label_value(val)}"' for key, val in labels)
+    return f"{{{label_str}}}"
+
+
+def _format_value(value):
+    """
+    format value of a sample
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+class MetricsRegistry:
+    """
+    thread-safe registry of counters, gauges and histograms with labels
+    """
+
+    def __init__(self, description_map=None, buckets=DEFAULT_BUCKETS):
+        self.lock = threading.Lock()
+        self.description_map = dict(METRIC_DESCRIPTION_MAP if description_map is None else description_map)
+        self.buckets = tuple(buckets)
+        # name: {sorted labels tuple: value}
+        self.value_dict = {}
+
+    def _get_samples(self, name):
+        if name not in self.description_map:
+            raise KeyError(f"undescribed metric {name}")
+        return self.value_dict.setdefault(name, {})
+
+    def describe(self, name, metric_type, help_str):
+        """
+        add description of a metric
+        """
+        with self.lock:
+            self.description_map[name] = (metric_type, help_str)
+
+    def inc(self, name, value=1, **labels):
+        """
+        increase a counter
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            samples = self._get_samples(name)
+            samples[key] = samples.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """
+        set a gauge
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self._get_samples(name)[key] = value
+
+    def observe(self, name, value, **labels):
+        """
+        observe a value into a histogram
+        """
+        key = tuple(sorted(labels.items()))
+        i_bucket = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            samples = self._get_samples(name)
+            if key not in samples:
+                # counts per bucket (the last for +Inf), sum, count
+                samples[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            hist = samples[key]
+            hist[0][i_bucket] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name, error_name=None, **labels):
+        """
+        context manager to observe duration of the block into a histogram, and to count exceptions raised if error_name is set
+        """
+        t_start = time.monotonic()
+        try:
+            yield
+        except Exception:
+            if error_name is not None:
+                self.inc(error_name, **labels)
+            raise
+        finally:
+            self.observe(name, time.monotonic() - t_start, **labels)
+
+    def get(self, name, **labels):
+        """
+        get current value of a counter or gauge, or tuple of sum and count of a histogram; None if not set
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            value = self.value_dict.get(name, {}).get(key)
+            if isinstance(value, list):
+                return value[1], value[2]
+            return value
+
+    def exposition(self):
+        """
+        return all metrics in Prometheus text exposition format
+        """
+        line_list = []
+        with self.lock:
+            for name in sorted(self.value_dict):
+                metric_type, help_str = self.description_map[name]
+                line_list.append(f"# HELP {name} {help_str}")
+                line_list.append(f"# TYPE {name} {metric_type}")
+                for key, value in sorted(self.value_dict[name].items()):
+                    if metric_type == "histogram":
+                        bucket_counts, value_sum, value_count = value
+                        cumulative = 0
+                        for upper, count in zip(self.buckets + (float("inf"),), bucket_counts):
+                            cumulative += count
+                            line_list.append(f"{name}_bucket{_format_labels(key + (('le', _format_value(upper)),))} {cumulative}")
+                        line_list.append(f"{name}_sum{_format_labels(key)} {_format_value(value_sum)}")
+                        line_list.append(f"{name}_count{_format_labels(key)} {value_count}")
+                    else:
+                        line_list.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(line_list) + "\n"
+
+
+# process-wide registry
+registry = MetricsRegistry()
+
+# ===============================================================
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP handler to serve the metrics
+    """
+
+    def do_GET(self):
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.exposition().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, address=""):
+    """
+    serve the metrics over HTTP on the port in a daemon thread; return the server
+    """
+    server = http.server.ThreadingHTTPServer((address, port), _MetricsRequestHandler)
+    server.daemon_threads = True
+    thr = threading.Thread(target=server.serve_forever, name="MetricsHTTPServer", daemon=True)
+    thr.start()
+    return server
+
+
+def write_textfile(path):
+    """
+    write the metrics atomically to the file, e.g. for textfile collector of node exporter
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as _f:
+        _f.write(registry.exposition())
+    os.replace(tmp_path, path)
+
+
+def start_textfile_writer(path, period=60):
+    """
+    write the metrics to the file every period in a daemon thread; return the thread
+    """
+    logger = logging.getLogger("hgcs_metrics")
+
+    def _loop():
+        while True:
+            try:
+                write_textfile(path)
+            except OSError as exc:
+                logger.warning(f"failed to write metrics to {path} : {exc}")
+            time.sleep(period)
+
+    thr = threading.Thread(target=_loop, name="MetricsTextfileWriter", daemon=True)
+    thr.start()
+    return thr
@@ -2,23 +2,71 @@
 common utilities of HGCS
 """
 
+import atexit
+import collections
+import contextlib
+import errno
+import fcntl
+import functools
+import gzip
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
+import re
+import shutil
+import sqlite3
 import threading
 import time
+import traceback
 
 from threading import get_ident
 
+from hgcs import metrics
+
 try:
     # try to import htcondor version 2 for htcondor version >= 25
+    import classad2 as classad
     import htcondor2 as htcondor
 except ImportError:
+    import classad
     import htcondor
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 
 # ===============================================================
 
-global_lock = threading.Lock()
+
+class InstrumentedLock:
+    """
+    lock recording time waited to acquire and time held into metrics, labeled with its name
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.acquired_time = None
+
+    def __enter__(self):
+        t_start = time.monotonic()
+        self.lock.acquire()
+        self.acquired_time = time.monotonic()
+        metrics.registry.observe("hgcs_lock_wait_seconds", self.acquired_time - t_start, lock=self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        metrics.registry.observe("hgcs_lock_held_seconds", time.monotonic() - self.acquired_time, lock=self.name)
+        self.lock.release()
+
 
 # ===============================================================
 
@@ -34,43 +82,1489 @@ LOG_LEVEL_MAP = {
 # ===============================================================
 
 
-def setup_logger(logger, pid=None, colored=True, to_file=None):
+LOG_FORMAT = "[%(asctime)s %(levelname)s](%(hgcs_pid)s)(%(name)s.%(funcName)s) %(message)s"
+
+# (minimum levelno, color) in descending order
+LOG_COLOR_LIST = [
+    (logging.CRITICAL, "\033[35;1m"),
+    (logging.ERROR, "\033[31;1m"),
+    (logging.WARNING, "\033[33;1m"),
+    (logging.INFO, "\033[32;1m"),
+    (logging.DEBUG, "\033[36;1m"),
+]
+
+
+class ColoredFormatter(logging.Formatter):
+    """
+    formatter with color by level, with formatters of all colors made in advance
+    """
+
+    def __init__(self, fmt=LOG_FORMAT):
+        logging.Formatter.__init__(self, fmt)
+        self.formatter_list = [(levelno, logging.Formatter(f"{color}{fmt}\033[0m")) for levelno, color in LOG_COLOR_LIST]
+        self.default_formatter = logging.Formatter(f"\033[0m{fmt}\033[0m")
+
+    def format(self, record):
+        for levelno, formatter in self.formatter_list:
+            if record.levelno >= levelno:
+                return formatter.format(record)
+        return self.default_formatter.format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    formatter of structured JSON lines
+    """
+
+    def format(self, record):
+        log_dict = {
+            "time": self.formatTime(record),
+            "timestamp": record.created,
+            "level": record.levelname,
+            "pid": getattr(record, "hgcs_pid", None),
+            "logger": record.name,
+            "func": record.funcName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            log_dict["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            log_dict["exception"] = record.exc_text
+        return json.dumps(log_dict)
+
+
+class _PidFilter(logging.Filter):
+    """
+    filter to attach the HGCS pid (process and thread IDs) to records of the logger
+    """
+
+    def __init__(self, pid):
+        logging.Filter.__init__(self)
+        self.pid = pid
+
+    def filter(self, record):
+        record.hgcs_pid = self.pid
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler only merging the message, without the full formatting of the base class in the calling thread
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # format traceback now not to keep frames alive in the queue
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+# destination (file path or None for stderr) -> QueueHandler, the only handler for the destination in the process
+_log_queue_handler_map = {}
+_log_listener_list = []
+_log_setup_lock = threading.Lock()
+# rotation of log files in process
+_log_rotation_dict = {"max_bytes": 0, "when": None, "backup_count": 5}
+
+
+def set_log_rotation(max_bytes=0, when=None, backup_count=5):
+    """
+    set rotation of log files made afterwards: by size if max_bytes > 0, else by time if when is set (e.g. "midnight", "W6"), else no rotation
+    """
+    with _log_setup_lock:
+        _log_rotation_dict.update({"max_bytes": max_bytes or 0, "when": when, "backup_count": backup_count})
+
+
+def _make_file_handler(to_file):
+    """
+    make file handler with rotation set
+    """
+    if _log_rotation_dict["max_bytes"] > 0:
+        return logging.handlers.RotatingFileHandler(to_file, maxBytes=_log_rotation_dict["max_bytes"], backupCount=_log_rotation_dict["backup_count"])
+    if _log_rotation_dict["when"]:
+        return logging.handlers.TimedRotatingFileHandler(to_file, when=_log_rotation_dict["when"], backupCount=_log_rotation_dict["backup_count"])
+    return logging.FileHandler(to_file)
+
+
+def reopen_log_files():
+    """
+    reopen all log files, e.g. after rotated by logrotate; the stream is swapped under the lock of the handler so no record is lost or split.
+    Return number of files reopened
+    """
+    n_reopened = 0
+    with _log_setup_lock:
+        for listener in _log_listener_list:
+            for hdlr in listener.handlers:
+                if not isinstance(hdlr, logging.FileHandler):
+                    continue
+                with hdlr.lock:
+                    old_stream = hdlr.stream
+                    hdlr.stream = hdlr._open()
+                    if old_stream is not None:
+                        old_stream.close()
+                n_reopened += 1
+    return n_reopened
+
+
+def stop_log_listeners():
+    """
+    flush queued records and stop the listeners, at exit
+    """
+    with _log_setup_lock:
+        while _log_listener_list:
+            listener = _log_listener_list.pop()
+            listener.stop()
+            for hdlr in listener.handlers:
+                hdlr.close()
+
+
+atexit.register(stop_log_listeners)
+
+
+def get_log_queue_handler(colored=True, to_file=None, json_format=False):
+    """
+    get the QueueHandler of the destination, making it and its QueueListener writing in a separate thread at the first call
+    """
+    with _log_setup_lock:
+        if to_file not in _log_queue_handler_map:
+            if to_file is not None:
+                hdlr = _make_file_handler(to_file)
+                colored = False
+            else:
+                hdlr = logging.StreamHandler()
+            if json_format:
+                hdlr.setFormatter(JsonFormatter())
+            elif colored:
+                hdlr.setFormatter(ColoredFormatter())
+            else:
+                hdlr.setFormatter(logging.Formatter(LOG_FORMAT))
+            log_queue = queue.SimpleQueue()
+            listener = logging.handlers.QueueListener(log_queue, hdlr, respect_handler_level=True)
+            listener.start()
+            _log_listener_list.append(listener)
+            _log_queue_handler_map[to_file] = _QueueHandler(log_queue)
+        return _log_queue_handler_map[to_file]
+
+
+def setup_logger(logger, pid=None, colored=True, to_file=None, json_format=False):
+    """
+    set up the logger to enqueue records to the shared logging pipeline of the destination,
+    so that threads logging never block on writing
+    """
+    for log_filter in list(logger.filters):
+        if isinstance(log_filter, _PidFilter):
+            logger.removeFilter(log_filter)
+    logger.addFilter(_PidFilter(pid))
+    queue_handler = get_log_queue_handler(colored=colored, to_file=to_file, json_format=json_format)
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
+
+
+# ===============================================================
+
+# ioctl request number of FICLONE on Linux, to make a reflink (shared extents) of a file
+FICLONE = 0x40049409
+
+# errno values meaning the copy method is not supported for the pair of files, thus to fall back
+_COPY_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+}
+
+
+def _kernel_copy(method, src_fd, dest_fd, blocksize, offset=0):
+    """
+    copy the content from offset of src_fd to the same offset of dest_fd in kernel with os.copy_file_range or os.sendfile
+    return number of bytes copied
+    """
+    start_offset = offset
+    if method == "sendfile":
+        os.lseek(dest_fd, offset, os.SEEK_SET)
+    while True:
+        if method == "copy_file_range":
+            n_bytes = os.copy_file_range(src_fd, dest_fd, blocksize, offset, offset)
+        else:
+            n_bytes = os.sendfile(dest_fd, src_fd, offset, blocksize)
+        if n_bytes == 0:
+            break
+        offset += n_bytes
+    return offset - start_offset
+
+
+def copy_file(src_path, dest_path, reflink=True):
+    """
+    copy content of src_path to dest_path (truncated if exists), without copying permission bits nor other metadata
+    try reflink (FICLONE) first if reflink is True, then in-kernel copy with os.copy_file_range or os.sendfile,
+    and fall back to userspace copy if none of them is supported for the pair of files
+    return tuple of number of bytes copied and the method used
+    """
+    with open(src_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
+        src_fd = fsrc.fileno()
+        dest_fd = fdst.fileno()
+        size = os.fstat(src_fd).st_size
+        if reflink:
+            try:
+                fcntl.ioctl(dest_fd, FICLONE, src_fd)
+            except OSError as exc:
+                if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+            else:
+                return size, "reflink"
+        blocksize = min(max(size, 2**23), 2**30)
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            try:
+                n_bytes = _kernel_copy(method, src_fd, dest_fd, blocksize)
+            except OSError as exc:
+                if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+                # restart from scratch with the next method
+                os.ftruncate(dest_fd, 0)
+                os.lseek(dest_fd, 0, os.SEEK_SET)
+            else:
+                if n_bytes == 0 and size > 0:
+                    # nothing copied from a non-empty source; some filesystems (e.g. procfs, some FUSE) do not support the method this way
+                    os.lseek(dest_fd, 0, os.SEEK_SET)
+                    continue
+                return n_bytes, method
+        fsrc.seek(0)
+        shutil.copyfileobj(fsrc, fdst)
+        return fdst.tell(), "userspace"
+
+
+def append_file(src_path, dest_path, offset=0):
+    """
+    copy content of src_path from offset to the same offset of dest_path (made if missing), dropping anything of dest_path beyond offset,
+    so that dest_path synced up to offset before is brought up to date by copying only the new bytes
+    return tuple of number of bytes copied and the method used
+    """
+    dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT, 0o666)
+    with open(src_path, "rb") as fsrc, open(dest_fd, "wb") as fdst:
+        src_fd = fsrc.fileno()
+        src_size = os.fstat(src_fd).st_size
+        os.ftruncate(dest_fd, offset)
+        for method in ("copy_file_range", "sendfile"):
+            if not hasattr(os, method):
+                continue
+            try:
+                n_bytes = _kernel_copy(method, src_fd, dest_fd, 2**23, offset)
+            except OSError as exc:
+                if exc.errno not in _COPY_FALLBACK_ERRNOS:
+                    raise
+                os.ftruncate(dest_fd, offset)
+            else:
+                if n_bytes == 0 and src_size > offset:
+                    # nothing copied though the source has new bytes; the method is not supported this way
+                    continue
+                return n_bytes, method
+        fsrc.seek(offset)
+        fdst.seek(offset)
+        shutil.copyfileobj(fsrc, fdst)
+        return fdst.tell() - offset, "userspace"
+
+
+def link_or_copy(src_path, dest_path):
+    """
+    make dest_path a hardlink of src_path if on the same filesystem, else copy with copy_file (reflink first)
+    an existing dest_path (e.g. partial copy) is replaced, as the link is made to a temporary name then renamed
+    return tuple of number of bytes (0 for hardlink) and the method used
+    """
+    tmp_path = f"{dest_path}.hgcs_tmp.{os.getpid()}.{get_ident()}"
+    try:
+        os.link(src_path, tmp_path)
+    except OSError as exc:
+        if exc.errno not in _COPY_FALLBACK_ERRNOS | {errno.EPERM, errno.EMLINK}:
+            raise
+    else:
+        try:
+            os.replace(tmp_path, dest_path)
+        finally:
+            # left if dest_path is already a hardlink of src_path, as rename does nothing then
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(tmp_path)
+        return 0, "hardlink"
+    return copy_file(src_path, dest_path)
+
+
+# file name suffixes of compression methods available for compress_file
+COMPRESS_SUFFIX_MAP = {"gzip": ".gz"}
+if zstandard is not None:
+    COMPRESS_SUFFIX_MAP["zstd"] = ".zst"
+
+
+# marker put in place of the middle of files truncated by iter_file_chunks
+TRUNCATION_MARKER = "\n[... {n_bytes} bytes truncated by HGCS ...]\n"
+
+
+def _read_chunks(fsrc, chunk_size, n_bytes=None):
+    while n_bytes is None or n_bytes > 0:
+        chunk = fsrc.read(chunk_size if n_bytes is None else min(chunk_size, n_bytes))
+        if not chunk:
+            return
+        if n_bytes is not None:
+            n_bytes -= len(chunk)
+        yield chunk
+
+
+def iter_file_chunks(fsrc, chunk_size=2**20, max_bytes=None):
+    """
+    yield content of the open file in chunks of at most chunk_size bytes
+    if the file is larger than max_bytes, only its first and last max_bytes/2 bytes with TRUNCATION_MARKER in between,
+    seeking over the middle so that it is never read
+    """
+    size = os.fstat(fsrc.fileno()).st_size
+    if not max_bytes or size <= max_bytes:
+        yield from _read_chunks(fsrc, chunk_size)
+        return
+    head_bytes = max_bytes // 2
+    tail_bytes = max_bytes - head_bytes
+    yield from _read_chunks(fsrc, chunk_size, head_bytes)
+    yield TRUNCATION_MARKER.format(n_bytes=size - head_bytes - tail_bytes).encode()
+    fsrc.seek(size - tail_bytes)
+    yield from _read_chunks(fsrc, chunk_size)
+
+
+def copy_file_truncated(src_path, dest_path, max_bytes, chunk_size=2**20):
+    """
+    copy the first and last max_bytes/2 bytes of src_path larger than max_bytes to dest_path (truncated if exists), with TRUNCATION_MARKER in between
+    return number of bytes written
+    """
+    with open(src_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
+        for chunk in iter_file_chunks(fsrc, chunk_size, max_bytes):
+            fdst.write(chunk)
+        return fdst.tell()
+
+
+def compress_file(src_path, dest_path, method="gzip", chunk_size=2**20, max_bytes=None):
+    """
+    compress content of src_path into dest_path (truncated if exists) with gzip or zstd, streaming chunks of chunk_size bytes
+    only the first and last max_bytes/2 bytes are compressed if the source is larger than max_bytes, as in iter_file_chunks
+    return tuple of number of bytes read and written
+    """
+    n_bytes_in = 0
+    with open(src_path, "rb") as fsrc, open(dest_path, "wb") as fdst:
+        if method == "zstd":
+            writer = zstandard.ZstdCompressor(level=3).stream_writer(fdst, closefd=False)
+        else:
+            writer = gzip.GzipFile(filename=os.path.basename(src_path), mode="wb", compresslevel=6, fileobj=fdst)
+        with writer:
+            for chunk in iter_file_chunks(fsrc, chunk_size, max_bytes):
+                writer.write(chunk)
+                n_bytes_in += len(chunk)
+        return n_bytes_in, fdst.tell()
+
+
+def write_file(dest_path, content):
+    """
+    write content in bytes to dest_path (truncated if exists); return number of bytes written
+    """
+    with open(dest_path, "wb") as fdst:
+        fdst.write(content)
+    return len(content)
+
+
+class ContentCache:
+    """
+    content-addressed LRU cache of small files in memory, to serve files read recently even after the source disappears
+    contents are keyed by SHA-256 digest, so the same content from different paths is stored once
+    """
+
+    def __init__(self, max_bytes=2**26, max_entry_bytes=2**20, max_paths=100000):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.max_paths = max_paths
+        self.lock = threading.Lock()
+        # digest: content, in LRU order
+        self.content_dict = collections.OrderedDict()
+        # path: digest, in LRU order
+        self.path_dict = collections.OrderedDict()
+        self.n_bytes = 0
+        # statistics
+        self.n_hits = 0
+        self.n_misses = 0
+
+    def put(self, path, content):
+        """
+        cache content of the file at path if small enough; return its digest, or None if not cached
+        """
+        if len(content) > self.max_entry_bytes:
+            return None
+        digest = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            if digest in self.content_dict:
+                self.content_dict.move_to_end(digest)
+            else:
+                self.content_dict[digest] = content
+                self.n_bytes += len(content)
+            self.path_dict[path] = digest
+            self.path_dict.move_to_end(path)
+            while self.n_bytes > self.max_bytes:
+                _, old_content = self.content_dict.popitem(last=False)
+                self.n_bytes -= len(old_content)
+            while len(self.path_dict) > self.max_paths:
+                self.path_dict.popitem(last=False)
+        return digest
+
+    def get(self, path):
+        """
+        get cached content of the file at path, or None if not cached
+        """
+        with self.lock:
+            digest = self.path_dict.get(path)
+            content = None if digest is None else self.content_dict.get(digest)
+            if content is None:
+                self.n_misses += 1
+                return None
+            self.content_dict.move_to_end(digest)
+            self.path_dict.move_to_end(path)
+            self.n_hits += 1
+            return content
+
+
+class _MadeEntry:
+    """
+    entry of a file made after its directory was scanned, like os.DirEntry
+    """
+
+    __slots__ = ("size", "is_link")
+
+    def __init__(self, size, is_link):
+        self.size = size
+        self.is_link = is_link
+
+    def is_file(self, follow_symlinks=True):
+        return not self.is_link
+
+    def is_symlink(self):
+        return self.is_link
+
+
+class DirStatCache:
+    """
+    metadata of files answered from one os.scandir of each of their directories, instead of stat calls per file
+    (round trips on NFS); meant to be made per cycle, as files changed by others after the scan are not seen
+    directories with more than max_entries entries or failing to be read are not cached and their files are checked directly
+    types of files are taken from the scan (d_type) without syscall, but sizes of scanned files need a stat each
+    """
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # directory path: {name: os.DirEntry or _MadeEntry}, or None if not cached
+        self.dir_dict = {}
+        # directory path: lock held while the directory is scanned
+        self.scan_lock_dict = {}
+        # statistics; metadata syscalls avoided by the cache, and made anyway
+        self.n_scans = 0
+        self.n_avoided = 0
+        self.n_direct = 0
+
+    @property
+    def n_saved(self):
+        """
+        number of metadata syscalls saved; syscalls avoided minus scans
+        """
+        return self.n_avoided - self.n_scans
+
+    def _count(self, n_avoided=0, n_direct=0):
+        with self.lock:
+            self.n_avoided += n_avoided
+            self.n_direct += n_direct
+
+    def _get_entry_dict(self, dir_path):
+        with self.lock:
+            if dir_path in self.dir_dict:
+                return self.dir_dict[dir_path]
+            scan_lock = self.scan_lock_dict.setdefault(dir_path, threading.Lock())
+        with scan_lock:
+            with self.lock:
+                if dir_path in self.dir_dict:
+                    return self.dir_dict[dir_path]
+            entry_dict = {}
+            try:
+                with os.scandir(dir_path) as entry_iter:
+                    for entry in entry_iter:
+                        if len(entry_dict) >= self.max_entries:
+                            entry_dict = None
+                            break
+                        entry_dict[entry.name] = entry
+            except (FileNotFoundError, NotADirectoryError):
+                # nothing in it
+                pass
+            except OSError:
+                entry_dict = None
+            with self.lock:
+                self.n_scans += 1
+                self.dir_dict[dir_path] = entry_dict
+            return entry_dict
+
+    def _lookup(self, path):
+        """
+        return tuple of whether path is cached and its entry (None if not found)
+        """
+        dir_path, name = os.path.split(os.path.normpath(path))
+        entry_dict = self._get_entry_dict(dir_path)
+        if entry_dict is None:
+            return False, None
+        with self.lock:
+            return True, entry_dict.get(name)
+
+    def exists(self, path):
+        """
+        whether path exists, like os.path.lexists
+        """
+        cached, entry = self._lookup(path)
+        if not cached:
+            self._count(n_direct=1)
+            return os.path.lexists(path)
+        self._count(n_avoided=1)
+        return entry is not None
+
+    def islink(self, path):
+        """
+        whether path is a symlink, like os.path.islink
+        """
+        cached, entry = self._lookup(path)
+        if not cached:
+            self._count(n_direct=1)
+            return os.path.islink(path)
+        self._count(n_avoided=1)
+        return entry is not None and entry.is_symlink()
+
+    def isfile(self, path):
+        """
+        whether path is a regular file or a symlink to it, like os.path.isfile
+        """
+        cached, entry = self._lookup(path)
+        if not cached or (entry is not None and entry.is_symlink()):
+            self._count(n_direct=1)
+            return os.path.isfile(path)
+        self._count(n_avoided=1)
+        return entry is not None and entry.is_file(follow_symlinks=False)
+
+    def isregular(self, path):
+        """
+        whether path is a regular file and not a symlink, in place of os.path.isfile and os.path.islink
+        """
+        cached, entry = self._lookup(path)
+        if not cached:
+            self._count(n_direct=2)
+            return os.path.isfile(path) and not os.path.islink(path)
+        self._count(n_avoided=2)
+        return entry is not None and entry.is_file(follow_symlinks=False) and not entry.is_symlink()
+
+    def getsize(self, path):
+        """
+        size of the file at path like os.path.getsize; only files made after the scan are answered without stat
+        """
+        cached, entry = self._lookup(path)
+        if isinstance(entry, _MadeEntry) and not entry.is_link:
+            self._count(n_avoided=1)
+            return entry.size
+        self._count(n_direct=1)
+        if not cached or entry is None or entry.is_symlink():
+            return os.path.getsize(path)
+        return entry.stat(follow_symlinks=False).st_size
+
+    def add(self, path, size=0, is_link=False):
+        """
+        record a file made at path after its directory was scanned
+        """
+        dir_path, name = os.path.split(os.path.normpath(path))
+        with self.lock:
+            entry_dict = self.dir_dict.get(dir_path)
+            if entry_dict is not None:
+                entry_dict[name] = _MadeEntry(size, is_link)
+
+
+# ===============================================================
+
+
+class HandledJobIndex:
+    """
+    persistent index of handled condor jobs, keyed by ClusterId.ProcId with the handled timestamp
+    stored in a table of SQLite database in WAL mode, thus the same file can be shared by agents with different tables
+    """
+
+    def __init__(self, db_path, table="handled_jobs"):
+        self.db_path = db_path
+        self.table = table
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} (job_id TEXT PRIMARY KEY, handled_timestamp REAL NOT NULL) WITHOUT ROWID")
+
+    def load(self):
+        """
+        load all handled jobs; return dict of job ID to handled timestamp
+        """
+        with self.lock:
+            return dict(self.conn.execute(f"SELECT job_id, handled_timestamp FROM {self.table}"))
+
+    def add(self, job_ids, timestamp=None):
+        """
+        add or update handled jobs in one batch
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)", ((job_id, timestamp) for job_id in job_ids))
+
+    def remove(self, job_ids):
+        """
+        remove jobs from the index in one batch
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(f"DELETE FROM {self.table} WHERE job_id = ?", ((job_id,) for job_id in job_ids))
+
+    def expire(self, before):
+        """
+        remove jobs handled before the timestamp; return number of jobs removed
+        """
+        with self.lock, self.conn:
+            self.conn.execute("BEGIN")
+            return self.conn.execute(f"DELETE FROM {self.table} WHERE handled_timestamp < ?", (before,)).rowcount
+
+    def close(self):
+        """
+        close the database
+        """
+        with self.lock:
+            self.conn.close()
+
+
+# ===============================================================
+
+
+# minimal projection to identify jobs
+MINIMAL_PROJECTION = ["ClusterId", "ProcId"]
+
+
+def pack_job_id(cluster_id, proc_id):
+    """
+    pack ClusterId and ProcId into one integer
+    """
+    return (int(cluster_id) << 32) | int(proc_id)
+
+
+def unpack_job_id(packed_id):
+    """
+    get tuple of ClusterId and ProcId from packed integer
+    """
+    return packed_id >> 32, packed_id & 0xFFFFFFFF
+
+
+def format_job_id(packed_id):
+    """
+    get job ID as ClusterId.ProcId from packed integer
+    """
+    return f"{packed_id >> 32}.{packed_id & 0xFFFFFFFF}"
+
+
+class JobRecord:
+    """
+    compact record of a job with the projected attributes only, got by name case-insensitively like a ClassAd
+    """
+
+    __slots__ = ("key_index", "values")
+
+    def __init__(self, key_index, values):
+        # lower-cased attribute name: index in values, shared by all records of the same projection
+        self.key_index = key_index
+        self.values = values
+
+    def get(self, key, default=None):
+        i_value = self.key_index.get(key.lower())
+        if i_value is None or self.values[i_value] is None:
+            return default
+        return self.values[i_value]
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    @property
+    def packed_id(self):
+        """
+        job ID packed into one integer
+        """
+        return pack_job_id(self.get("ClusterId"), self.get("ProcId"))
+
+
+def iter_job_records(ads, projection):
     """
-    set up the logger
+    convert job ads into JobRecord with attributes of the projection one by one, lazily;
+    a list of ads is consumed so that each full ad is freed once converted
     """
-    if to_file is not None:
-        hdlr = logging.FileHandler(to_file)
-        colored = False
+    key_index = {attr.lower(): i_attr for i_attr, attr in enumerate(projection)}
+    attr_tuple = tuple(projection)
+    if isinstance(ads, list):
+        ads.reverse()
+        while ads:
+            ad = ads.pop()
+            yield JobRecord(key_index, tuple(ad.get(attr) for attr in attr_tuple))
     else:
-        hdlr = logging.StreamHandler()
-
-    def emit_decorator(orig_func):
-        def func(*args):
-            _fstr = f"[%(asctime)s %(levelname)s]({pid})(%(name)s.%(funcName)s) %(message)s"
-            format_str = _fstr
-            if colored:
-                levelno = args[0].levelno
-                if levelno >= logging.CRITICAL:
-                    color = "\033[35;1m"
-                elif levelno >= logging.ERROR:
-                    color = "\033[31;1m"
-                elif levelno >= logging.WARNING:
-                    color = "\033[33;1m"
-                elif levelno >= logging.INFO:
-                    color = "\033[32;1m"
-                elif levelno >= logging.DEBUG:
-                    color = "\033[36;1m"
+        for ad in ads:
+            yield JobRecord(key_index, tuple(ad.get(attr) for attr in attr_tuple))
+
+
+# ===============================================================
+
+
+class ExpiringJobIdSet:
+    """
+    set of job IDs where each entry expires ttl seconds after added, instead of flushing the whole set at once
+    entries are kept as packed integers in sets bucketed by time of addition, so expiring drops whole buckets;
+    job IDs are accepted as ClusterId.ProcId strings or packed integers, and iterated as strings
+    """
+
+    def __init__(self, ttl, bucket_period=None):
+        self.ttl = ttl
+        # granularity of expiration, 1/24 of ttl by default
+        self.bucket_period = bucket_period if bucket_period else max(ttl / 24, 1)
+        # bucket key (start time // bucket_period): set of packed job IDs
+        self.bucket_dict = {}
+
+    @staticmethod
+    def _pack(job_id):
+        if isinstance(job_id, int):
+            return job_id
+        cluster_id, proc_id = str(job_id).split(".")
+        return pack_job_id(cluster_id, proc_id)
+
+    def _get_bucket(self, timestamp):
+        key = int(timestamp // self.bucket_period)
+        bucket = self.bucket_dict.get(key)
+        if bucket is None:
+            bucket = self.bucket_dict[key] = set()
+        return bucket
+
+    def __contains__(self, job_id):
+        packed_id = self._pack(job_id)
+        return any(packed_id in bucket for bucket in self.bucket_dict.values())
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.bucket_dict.values())
+
+    def __iter__(self):
+        for bucket in list(self.bucket_dict.values()):
+            for packed_id in list(bucket):
+                yield format_job_id(packed_id)
+
+    def add(self, job_id, timestamp=None):
+        """
+        add a job ID, handled at timestamp (now by default); an existing entry is kept with its time
+        """
+        packed_id = self._pack(job_id)
+        if packed_id not in self:
+            self._get_bucket(time.time() if timestamp is None else timestamp).add(packed_id)
+
+    def update(self, job_ids, timestamp=None):
+        """
+        add job IDs handled at timestamp (now by default), or from dict of job ID to timestamp
+        """
+        if isinstance(job_ids, dict):
+            for job_id, job_timestamp in job_ids.items():
+                self.add(job_id, job_timestamp)
+        else:
+            for job_id in job_ids:
+                self.add(job_id, timestamp)
+
+    def discard(self, job_id):
+        packed_id = self._pack(job_id)
+        for bucket in self.bucket_dict.values():
+            bucket.discard(packed_id)
+
+    def difference_update(self, job_ids):
+        packed_id_set = {self._pack(job_id) for job_id in job_ids}
+        for bucket in self.bucket_dict.values():
+            bucket.difference_update(packed_id_set)
+
+    def expire(self, now=None):
+        """
+        drop buckets of entries older than ttl; return number of entries expired
+        """
+        if now is None:
+            now = time.time()
+        n_expired = 0
+        for key in list(self.bucket_dict):
+            if (key + 1) * self.bucket_period <= now - self.ttl or not self.bucket_dict[key]:
+                n_expired += len(self.bucket_dict.pop(key))
+        return n_expired
+
+
+# ===============================================================
+
+
+def make_job_id_constraint(job_ids):
+    """
+    make ClassAd constraint expression matching exactly the condor jobs of job IDs (ClusterId.ProcId), grouped by ClusterId
+    """
+    procs_by_cluster = {}
+    for job_id in job_ids:
+        cluster_id, proc_id = str(job_id).split(".")
+        procs_by_cluster.setdefault(int(cluster_id), set()).add(int(proc_id))
+    if not procs_by_cluster:
+        return "false"
+    expr_list = []
+    for cluster_id, proc_id_set in sorted(procs_by_cluster.items()):
+        procs_str = ",".join(str(proc_id) for proc_id in sorted(proc_id_set))
+        expr_list.append(f"( ClusterId == {cluster_id} && member(ProcId, {{{procs_str}}}) )")
+    return "( " + " || ".join(expr_list) + " )"
+
+
+class JobEventTailer:
+    """
+    tail a job event log (e.g. the global EVENT_LOG of the schedd) incrementally and collect jobs with events of interest
+    the log is read directly, from its end when (re)opened so that events written before are never parsed;
+    events in the default text format and in JSON format are recognized
+    """
+
+    # header line of an event in text format, e.g. 005 (123.000.000) ...
+    text_header_re = re.compile(rb"^(\d{3}) \((\d+)\.(\d+)\.\d+\)", re.MULTILINE)
+    # fields of an event in JSON format
+    json_field_re = re.compile(rb'"(EventTypeNumber|Cluster|Proc)"\s*:\s*(\d+)')
+    # line ending each event
+    event_separator = b"\n...\n"
+
+    def __init__(self, event_log_path, event_types):
+        self.event_log_path = event_log_path
+        self.event_type_set = {int(event_type) for event_type in event_types}
+        self.file = None
+        self.inode = None
+        # incomplete event at the end of the log
+        self.buffer = b""
+
+    def _parse_event(self, event_text):
+        """
+        get tuple of event type number and job ID of the event, or None if not recognized
+        """
+        match = self.text_header_re.search(event_text)
+        if match:
+            return int(match.group(1)), f"{int(match.group(2))}.{int(match.group(3))}"
+        field_dict = dict(self.json_field_re.findall(event_text))
+        if len(field_dict) == 3:
+            return int(field_dict[b"EventTypeNumber"]), f"{int(field_dict[b'Cluster'])}.{int(field_dict[b'Proc'])}"
+        return None
+
+    def poll(self):
+        """
+        read events appended since last poll without blocking
+        return tuple of dict of job ID to the time its latest event of interest is read, and whether the event log has just been (re)opened;
+        in the latter case events before are unknown (and skipped) so a full scan is needed
+        """
+        inode = os.stat(self.event_log_path).st_ino
+        if self.file is not None and inode == self.inode and os.fstat(self.file.fileno()).st_size < self.file.tell():
+            # truncated in place
+            self.close()
+        if self.file is None or inode != self.inode:
+            # first open or the event log was rotated
+            self.close()
+            self.file = open(self.event_log_path, "rb")
+            self.file.seek(0, os.SEEK_END)
+            self.inode = inode
+            return {}, True
+        self.buffer += self.file.read()
+        *event_text_list, self.buffer = self.buffer.split(self.event_separator)
+        job_id_dict = {}
+        now = time.time()
+        for event_text in event_text_list:
+            parsed = self._parse_event(event_text)
+            if parsed is not None and parsed[0] in self.event_type_set:
+                job_id_dict[parsed[1]] = now
+        return job_id_dict, False
+
+    def close(self):
+        """
+        close the event log
+        """
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.inode = None
+            self.buffer = b""
+
+
+# ===============================================================
+
+# priorities of schedd calls, lower goes first
+PRIORITY_HIGH = 0
+PRIORITY_BULK = 10
+
+
+class ScheddUnavailableError(RuntimeError):
+    """
+    schedd calls refused by the governor while its circuit breaker is open
+    """
+
+    pass
+
+
+class ScheddGovernor:
+    """
+    process-wide governor of schedd calls of all agents, to keep the load on the schedd bounded:
+    at most max_concurrency calls at once, at most rate calls per second on average (token bucket of burst),
+    waiting calls served in order of priority,
+    and a circuit breaker opened for a jittered exponential backoff after failure_threshold consecutive failed calls,
+    then half-open letting one call through to probe the schedd;
+    calls longer than slow_call_threshold seconds count as failed too if it is set (off by default, as full queries of big queues are slow);
+    long calls (e.g. transfers of sandboxes) take at most max_concurrency - 1 slots at once, so that one is left for other calls
+    """
+
+    def __init__(
+        self,
+        name="schedd",
+        max_concurrency=2,
+        rate=10.0,
+        burst=20,
+        failure_threshold=5,
+        slow_call_threshold=None,
+        backoff_base=5.0,
+        backoff_max=600.0,
+        max_wait=60.0,
+        logger=None,
+    ):
+        self.name = name
+        self.logger = logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        self.cond = threading.Condition()
+        self.waiting_heap = []
+        self.counter = itertools.count()
+        self.n_active = 0
+        self.n_active_long = 0
+        self.token_timestamp = time.monotonic()
+        # parameters, updated by configure
+        self.max_concurrency = max_concurrency
+        self.rate = rate
+        self.burst = burst
+        self.failure_threshold = failure_threshold
+        # None to disable
+        self.slow_call_threshold = slow_call_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self.tokens = float(self.burst)
+        # circuit breaker
+        self.n_consecutive_failures = 0
+        self.n_opens = 0
+        self.open_until = 0.0
+        # statistics
+        self.latency_ewma = None
+        self.error_rate_ewma = 0.0
+
+    def configure(self, **kwargs):
+        """
+        update parameters set in __init__; None values are ignored
+        """
+        with self.cond:
+            for key, val in kwargs.items():
+                if not hasattr(self, key):
+                    raise AttributeError(f"unknown parameter {key} of {self.__class__.__name__}")
+                if val is not None:
+                    setattr(self, key, val)
+            self.cond.notify_all()
+
+    def _is_half_open(self):
+        return self.n_consecutive_failures >= self.failure_threshold
+
+    def _refill(self, now):
+        self.tokens = min(self.tokens + (now - self.token_timestamp) * self.rate, self.burst)
+        self.token_timestamp = now
+
+    def _is_next(self, entry, max_concurrency):
+        """
+        whether the waiting entry is the first one in order of priority among those which may take a slot
+        """
+        if self.waiting_heap[0] == entry:
+            return True
+        if entry[2] or self.n_active_long < max(max_concurrency - 1, 1):
+            return False
+        # long calls at their limit let other calls pass
+        return entry == min(waiting for waiting in self.waiting_heap if not waiting[2])
+
+    def acquire(self, priority=PRIORITY_BULK, long_call=False):
+        """
+        wait for a slot to call the schedd; raise ScheddUnavailableError if the circuit stays open longer than max_wait
+        """
+        t_start = time.monotonic()
+        with self.cond:
+            entry = (priority, next(self.counter), long_call)
+            heapq.heappush(self.waiting_heap, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    if now < self.open_until and self.open_until - now > self.max_wait:
+                        raise ScheddUnavailableError(f"schedd circuit breaker open for {self.open_until - now:.0f} sec")
+                    wait_time = None
+                    max_concurrency = 1 if self._is_half_open() else self.max_concurrency
+                    if (
+                        self._is_next(entry, max_concurrency)
+                        and self.n_active < max_concurrency
+                        and not (long_call and self.n_active_long >= max(max_concurrency - 1, 1))
+                    ):
+                        if now < self.open_until:
+                            wait_time = self.open_until - now
+                        else:
+                            self._refill(now)
+                            if self.tokens >= 1:
+                                break
+                            wait_time = (1 - self.tokens) / self.rate
+                    self.cond.wait(wait_time)
+                self.tokens -= 1
+                self.n_active += 1
+                if long_call:
+                    self.n_active_long += 1
+            finally:
+                if self.waiting_heap[0] == entry:
+                    heapq.heappop(self.waiting_heap)
+                else:
+                    self.waiting_heap.remove(entry)
+                    heapq.heapify(self.waiting_heap)
+                self.cond.notify_all()
+        return time.monotonic() - t_start
+
+    def release(self, succeeded, latency, check_slow=True, count_failure=True):
+        """
+        record the result of a call and free its slot; the call counts as failed if slow unless check_slow is False, i.e. a long call;
+        an unsuccessful call with count_failure False neither counts as failed nor closes the circuit
+        """
+        with self.cond:
+            self.n_active -= 1
+            if not check_slow:
+                self.n_active_long -= 1
+            self.latency_ewma = latency if self.latency_ewma is None else 0.9 * self.latency_ewma + 0.1 * latency
+            failed = (not succeeded and count_failure) or (check_slow and self.slow_call_threshold is not None and latency > self.slow_call_threshold)
+            if not succeeded and not failed:
+                self.cond.notify_all()
+                return
+            self.error_rate_ewma = 0.9 * self.error_rate_ewma + (0.1 if failed else 0.0)
+            if failed:
+                self.n_consecutive_failures += 1
+                if self.n_consecutive_failures >= self.failure_threshold:
+                    self.n_opens += 1
+                    backoff = min(self.backoff_base * 2 ** (self.n_opens - 1), self.backoff_max) * random.uniform(0.5, 1.0)
+                    self.open_until = time.monotonic() + backoff
+                    self.logger.warning(
+                        f"circuit breaker of {self.name} opened for {backoff:.1f} sec after {self.n_consecutive_failures} consecutive failed calls ; "
+                        f"latency EWMA {self.latency_ewma:.3f} sec, error rate EWMA {self.error_rate_ewma:.2f}"
+                    )
+                    metrics.registry.set("hgcs_schedd_circuit_open", 1, schedd=self.name)
+            else:
+                if self.n_opens:
+                    self.logger.info(f"circuit breaker of {self.name} closed")
+                    metrics.registry.set("hgcs_schedd_circuit_open", 0, schedd=self.name)
+                self.n_consecutive_failures = 0
+                self.n_opens = 0
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def call(self, agent, call, priority=PRIORITY_BULK, check_slow=True, count_failure=True):
+        """
+        context manager to make a schedd call in the block under the governor, recording its duration and failure
+        set check_slow to False for calls expected to be long (e.g. transfers of sandboxes) not to trip the circuit breaker nor take all slots,
+        and count_failure to False for calls which may fail because of their arguments (e.g. edits of jobs gone) rather than the schedd
+        """
+        wait_time = self.acquire(priority, long_call=not check_slow)
+        metrics.registry.observe("hgcs_schedd_governor_wait_seconds", wait_time, agent=agent, schedd=self.name)
+        t_start = time.monotonic()
+        succeeded = False
+        try:
+            with metrics.registry.timer("hgcs_schedd_call_seconds", error_name="hgcs_schedd_call_errors_total", agent=agent, call=call, schedd=self.name):
+                yield
+            succeeded = True
+        except GeneratorExit:
+            # streaming query closed early by the consumer
+            succeeded = True
+            raise
+        finally:
+            self.release(succeeded, time.monotonic() - t_start, check_slow, count_failure)
+
+
+# process-wide governor
+schedd_governor = ScheddGovernor()
+
+
+# ===============================================================
+
+
+class ScheddPool:
+    """
+    pool of schedd handles, one per thread, so that agents never share a handle;
+    a handle is health-checked before use when health_check_period has passed or recent schedd calls failed,
+    and replaced by a new one (locating the schedd again) when unhealthy
+    """
+
+    def __init__(self, name="schedd", schedd_factory=None, governor=None, health_check_period=300, logger=None):
+        self.name = name
+        self.schedd_factory = schedd_factory if schedd_factory is not None else htcondor.Schedd
+        self.governor = governor if governor is not None else schedd_governor
+        self.health_check_period = health_check_period
+        self.logger = logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        self.local = threading.local()
+        # serialize job actions (e.g. remove-x), which are long blocking calls, without blocking other calls
+        self.act_lock = InstrumentedLock(f"{name}.act")
+
+    def _check_health(self, schedd):
+        """
+        check the schedd responds with a query matching no job
+        """
+        try:
+            with self.governor.call(self.__class__.__name__, "health_check", priority=PRIORITY_HIGH):
+                schedd.query(constraint="false", projection=["ClusterId"], limit=1)
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.warning(f"health check of {self.name} handle failed: {exc}")
+            return False
+        return True
+
+    def get(self):
+        """
+        get the healthy schedd handle of the current thread, making a new one if needed;
+        raise RuntimeError or HTCondorException if failed to make it
+        """
+        schedd = getattr(self.local, "schedd", None)
+        now = time.monotonic()
+        if schedd is not None and (now >= self.local.check_timestamp + self.health_check_period or self.governor.n_consecutive_failures):
+            if self._check_health(schedd):
+                self.local.check_timestamp = now
+            else:
+                self.invalidate()
+                schedd = None
+        if schedd is None:
+            schedd = self.schedd_factory()
+            self.local.schedd = schedd
+            self.local.check_timestamp = now
+            metrics.registry.inc("hgcs_schedd_connections_total", schedd=self.name)
+            self.logger.debug(f"made new handle of {self.name} for thread {get_ident()}")
+        return schedd
+
+    def invalidate(self):
+        """
+        drop the schedd handle of the current thread, to make a new one at next get
+        """
+        self.local.schedd = None
+
+
+# process-wide pool of the local schedd
+schedd_pool = ScheddPool()
+
+
+def make_schedd_factory(schedd_spec, collector=None):
+    """
+    make function to get a schedd handle from the spec: the address (sinful string like <host:port?...>) of the schedd,
+    or the name of the schedd to locate via the collector (local one if collector is None)
+    """
+    if schedd_spec.startswith("<"):
+        # version of the schedd assumed the same as the bindings
+        location_ad = classad.ClassAd({"MyType": "Scheduler", "Name": schedd_spec, "MyAddress": schedd_spec, "CondorVersion": htcondor.version()})
+        return functools.partial(htcondor.Schedd, location_ad)
+
+    def _locate():
+        location_ad = htcondor.Collector(collector).locate(htcondor.DaemonTypes.Schedd, schedd_spec)
+        return htcondor.Schedd(location_ad)
+
+    return _locate
+
+
+# ===============================================================
+
+
+class QueueSnapshot:
+    """
+    snapshot of the job queue of the schedd shared by agents
+    refreshed with one query with the union of constraints and projections registered by agents at most once per period,
+    or at the next query after any agent edits or acts on jobs, while each agent filters the snapshot locally with its own constraint
+    """
+
+    def __init__(self, period=60, governor=None, logger=None):
+        self.period = period
+        self.governor = governor if governor is not None else schedd_governor
+        self.logger = logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        self.lock = threading.Lock()
+        self.constraint_dict = {}
+        self.projection_set = {"ClusterId", "ProcId"}
+        self.job_list = []
+        self.timestamp = 0
+        self.to_refresh = True
+        # generations of edits or actions by agents, and the last one seen by the snapshot
+        self.edit_generation = 0
+        self.refreshed_generation = 0
+        # statistics
+        self.n_refreshes = 0
+        self.refresh_time = 0.0
+        self.n_served = 0
+        self.n_served_since_refresh = 0
+        self.saved_time = 0.0
+
+    def register(self, name, constraint, projection=None):
+        """
+        register the constraint and projection of an agent to include in the snapshot
+        attributes referred by the constraint are added to the projection, so that it can be evaluated locally
+        """
+        with self.lock:
+            self.constraint_dict[name] = constraint
+            self.projection_set.update(classad.ClassAd().externalRefs(classad.ExprTree(constraint)))
+            if projection:
+                self.projection_set.update(projection)
+            self.to_refresh = True
+
+    def invalidate(self):
+        """
+        make the next query refresh the snapshot, after jobs are edited or acted on; without waiting for a refresh in progress
+        """
+        self.edit_generation += 1
+
+    def refresh(self, schedd, priority=PRIORITY_BULK):
+        """
+        query the schedd with the union of registered constraints and projections; call with lock held
+        """
+        # edits after this point are not surely seen by the query
+        generation = self.edit_generation
+        union_constraint = " || ".join(f"( {constraint} )" for constraint in self.constraint_dict.values())
+        t_start = time.monotonic()
+        with self.governor.call(self.__class__.__name__, "query", priority=priority):
+            self.job_list = list(schedd.query(constraint=union_constraint, projection=sorted(self.projection_set)))
+        t_spent = time.monotonic() - t_start
+        self.timestamp = time.time()
+        self.to_refresh = False
+        self.refreshed_generation = generation
+        self.n_refreshes += 1
+        self.refresh_time += t_spent
+        # each agent query served from the snapshot would otherwise have cost a schedd query of similar time
+        avg_query_time = self.refresh_time / self.n_refreshes
+        self.saved_time += max(self.n_served_since_refresh - 1, 0) * avg_query_time
+        self.logger.info(
+            f"refreshed with {len(self.job_list)} jobs in {t_spent:.3f} sec ; "
+            f"served {self.n_served_since_refresh} agent queries with last snapshot ; "
+            f"total {self.n_refreshes} schedd queries for {self.n_served} agent queries, saved about {self.saved_time:.3f} sec of schedd time"
+        )
+        self.n_served_since_refresh = 0
+
+    def query(self, schedd, constraint, limit=-1, priority=PRIORITY_BULK):
+        """
+        return list of jobs in the snapshot matching the constraint, refreshing the snapshot first if outdated
+        the constraint must be narrower than a registered one
+        """
+        with self.lock:
+            if self.to_refresh or self.refreshed_generation != self.edit_generation or time.time() >= self.timestamp + self.period:
+                self.refresh(schedd, priority=priority)
+            job_list = self.job_list
+            self.n_served += 1
+            self.n_served_since_refresh += 1
+        expr = classad.ExprTree(constraint)
+        ret_list = []
+        for job in job_list:
+            if expr.eval(job) is True:
+                ret_list.append(job)
+                if len(ret_list) == limit:
+                    break
+        return ret_list
+
+
+# ===============================================================
+
+
+class BatchEditor:
+    """
+    edit an attribute of many condor jobs in chunks, with the chunk size adapted to the observed latency of edits
+    failed chunks are bisected to isolate the bad job IDs, so that the other jobs in the chunk are still edited;
+    only failures of whole chunks count towards giving up, while failures of bisected parts, which are expected with bad job IDs,
+    make the schedd probed once they pile up, giving up if it does not respond
+    """
+
+    def __init__(
+        self,
+        name=None,
+        logger=None,
+        governor=None,
+        priority=PRIORITY_BULK,
+        target_latency=2.0,
+        initial_chunk_size=1000,
+        min_chunk_size=10,
+        max_chunk_size=20000,
+        n_try=3,
+        max_consecutive_failures=16,
+        probe_after_failures=4,
+        queue_snapshot=None,
+    ):
+        self.name = name if name is not None else self.__class__.__name__
+        self.logger = logger if logger is not None else logging.getLogger(self.__class__.__name__)
+        self.governor = governor if governor is not None else schedd_governor
+        self.priority = priority
+        self.target_latency = target_latency
+        self.chunk_size = initial_chunk_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.n_try = n_try
+        self.max_consecutive_failures = max_consecutive_failures
+        self.n_consecutive_failures = 0
+        self.probe_after_failures = probe_after_failures
+        self.n_bisect_failures = 0
+        # job IDs failed alone while the schedd responded in the last edit, probably gone from the queue
+        self.bad_job_id_list = []
+        # snapshot to invalidate after edits
+        self.queue_snapshot = queue_snapshot
+
+    def _probe(self, schedd):
+        """
+        check the schedd responds with a query matching no job; return True if it does, False otherwise
+        """
+        try:
+            with self.governor.call(self.name, "probe", priority=self.priority):
+                schedd.query(constraint="false", projection=["ClusterId"], limit=1)
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.warning(f"schedd not responding after failed edits: {exc}")
+            return False
+        return True
+
+    def _try_edit(self, schedd, job_id_list, attr, value, whole_chunk=True):
+        """
+        edit the jobs in one call; return True if succeeded, False otherwise
+        """
+        t_start = time.monotonic()
+        try:
+            with self.governor.call(self.name, "edit", priority=self.priority, count_failure=whole_chunk):
+                try:
+                    schedd.edit(job_id_list, attr, value)
+                finally:
+                    if self.queue_snapshot is not None:
+                        self.queue_snapshot.invalidate()
+        except ScheddUnavailableError as exc:
+            # circuit breaker open; give up the rest without retrying nor bisecting
+            self.n_consecutive_failures = self.max_consecutive_failures
+            self.logger.debug(f"failed to edit {len(job_id_list)} jobs : {exc}")
+            return False
+        except (RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.debug(f"failed to edit {len(job_id_list)} jobs : {exc}")
+            if whole_chunk:
+                self.n_consecutive_failures += 1
+            else:
+                self.n_bisect_failures += 1
+                if self.n_bisect_failures >= self.probe_after_failures:
+                    self.n_bisect_failures = 0
+                    if not self._probe(schedd):
+                        self.n_consecutive_failures = self.max_consecutive_failures
+            return False
+        t_spent = time.monotonic() - t_start
+        self.n_consecutive_failures = 0
+        self.n_bisect_failures = 0
+        # adapt chunk size with latency of full chunks
+        if len(job_id_list) >= self.chunk_size:
+            if t_spent < self.target_latency / 2:
+                self.chunk_size = min(self.chunk_size * 2, self.max_chunk_size)
+            elif t_spent > self.target_latency:
+                self.chunk_size = max(int(self.chunk_size * self.target_latency / t_spent), self.min_chunk_size)
+        return True
+
+    def _edit_bisect(self, schedd, job_id_list, attr, value, succeeded_list, failed_list):
+        """
+        edit the jobs, bisecting on failure down to single jobs
+        """
+        if self.n_consecutive_failures >= self.max_consecutive_failures:
+            # schedd probably unavailable; give up the rest
+            failed_list.extend(job_id_list)
+        elif self._try_edit(schedd, job_id_list, attr, value, whole_chunk=False):
+            succeeded_list.extend(job_id_list)
+        elif len(job_id_list) == 1:
+            failed_list.extend(job_id_list)
+            if self.n_consecutive_failures < self.max_consecutive_failures:
+                self.bad_job_id_list.extend(job_id_list)
+        else:
+            middle = len(job_id_list) // 2
+            self._edit_bisect(schedd, job_id_list[:middle], attr, value, succeeded_list, failed_list)
+            self._edit_bisect(schedd, job_id_list[middle:], attr, value, succeeded_list, failed_list)
+
+    def edit(self, schedd, job_ids, attr, value):
+        """
+        set the attribute to the value (ClassAd expression in string) for the jobs of job IDs (ClusterId.ProcId)
+        return tuple of list of job IDs succeeded and list of job IDs failed; the failed ones which are bad are kept in bad_job_id_list
+        """
+        job_id_list = sorted(job_ids)
+        succeeded_list = []
+        failed_list = []
+        self.n_consecutive_failures = 0
+        self.n_bisect_failures = 0
+        self.bad_job_id_list = []
+        i_start = 0
+        while i_start < len(job_id_list):
+            chunk = job_id_list[i_start : i_start + self.chunk_size]
+            i_start += len(chunk)
+            if self.n_consecutive_failures >= self.max_consecutive_failures:
+                # schedd probably unavailable; give up the rest
+                failed_list.extend(chunk)
+                continue
+            # retry the whole chunk in case of transient error before bisecting
+            for i_try in range(1, self.n_try + 1):
+                if self._try_edit(schedd, chunk, attr, value):
+                    succeeded_list.extend(chunk)
+                    break
+                if i_try < self.n_try and self.n_consecutive_failures < self.max_consecutive_failures:
+                    time.sleep(1)
+            else:
+                if len(chunk) > 1:
+                    self.logger.warning(f"failed to edit {attr} of {len(chunk)} jobs ; bisect to isolate bad jobs")
+                    middle = len(chunk) // 2
+                    self._edit_bisect(schedd, chunk[:middle], attr, value, succeeded_list, failed_list)
+                    self._edit_bisect(schedd, chunk[middle:], attr, value, succeeded_list, failed_list)
                 else:
-                    color = "\033[0m"
-                format_str = f"{color}{_fstr}\033[0m"
-            formatter = logging.Formatter(format_str)
-            hdlr.setFormatter(formatter)
-            return orig_func(*args)
+                    failed_list.extend(chunk)
+                    if self.n_consecutive_failures < self.max_consecutive_failures and self._probe(schedd):
+                        self.bad_job_id_list.extend(chunk)
+        if failed_list:
+            self.logger.warning(f"failed to edit {attr} of {len(failed_list)} jobs")
+            self.logger.debug(f"failed to edit {attr} of jobs: {' '.join(failed_list)}")
+        return succeeded_list, failed_list
+
+
+# ===============================================================
 
-        return func
 
-    hdlr.emit = emit_decorator(hdlr.emit)
-    logger.addHandler(hdlr)
+class AdaptiveScheduler:
+    """
+    scheduler of intervals between cycles of an agent:
+    min_period while there is backlog, base period while jobs are found, and backing off exponentially up to max_period while idle
+    max_period is the base period by default, i.e. no backoff unless set
+    """
+
+    def __init__(self, period=60, min_period=None, max_period=None, backoff_factor=2.0, name=None):
+        self.period = period
+        self.min_period = min(period, max(1, period // 10)) if min_period is None else min_period
+        self.max_period = period if max_period is None else max(max_period, period)
+        self.backoff_factor = backoff_factor
+        self.name = name
+        self.interval = period
+
+    def next_interval(self, n_jobs, backlog=False, due_in=None, failed=False):
+        """
+        get the interval before next cycle according to number of jobs processed and whether backlog remains;
+        not longer than due_in seconds (if set) when some jobs get due then; a failed cycle backs off like an idle one
+        """
+        if failed:
+            self.interval = min(max(self.interval, self.period) * self.backoff_factor, self.max_period)
+        elif backlog:
+            self.interval = self.min_period
+        elif n_jobs:
+            self.interval = self.period
+        else:
+            self.interval = min(max(self.interval, self.period) * self.backoff_factor, self.max_period)
+        interval = self.interval
+        if due_in is not None:
+            interval = min(max(due_in, self.min_period), interval)
+        metrics.registry.set("hgcs_agent_sleep_seconds", interval, agent=self.name)
+        return interval
 
 
 # ===============================================================
@@ -81,42 +1575,270 @@ class ThreadBase(threading.Thread):
     base class of thread to run HGCS agents
     """
 
+    # priority of schedd calls of the agent
+    schedd_priority = PRIORITY_BULK
+
     def __init__(self, sleep_period=60, **kwargs):
         threading.Thread.__init__(self)
         self.os_pid = os.getpid()
-        self.logger = logging.getLogger(self.__class__.__name__)
+        # name of the schedd if the process serves several schedds, else None for the local schedd
+        self.schedd_name = kwargs.get("schedd_name")
+        if self.schedd_name is None:
+            self.agent_name = self.__class__.__name__
+        else:
+            self.agent_name = f"{self.__class__.__name__}@{self.schedd_name}"
+        self.logger = logging.getLogger(self.agent_name)
         self.sleep_period = sleep_period
         self.start_timestamp = time.time()
         self.logger_format_colored = kwargs.get("logger_format_colored")
         self.log_level = kwargs.get("log_level")
         self.log_file = kwargs.get("log_file")
-    
+        self.log_json = kwargs.get("log_json", False)
+        self.handled_index_file = kwargs.get("handled_index_file")
+        self.handled_index = None
+        self.discovery_mode = kwargs.get("discovery_mode") or "query"
+        self.event_log_file = kwargs.get("event_log_file")
+        self.reconcile_period = kwargs.get("reconcile_period") or 3600
+        self.event_tailer = None
+        self.last_reconcile_timestamp = 0
+        self.queue_snapshot = kwargs.get("queue_snapshot")
+        self.schedd_pool = kwargs.get("schedd_pool") or schedd_pool
+        self.batch_editor = BatchEditor(
+            name=self.agent_name, logger=self.logger, governor=self.schedd_pool.governor, priority=self.schedd_priority, queue_snapshot=self.queue_snapshot
+        )
+        self.scheduler = AdaptiveScheduler(
+            period=sleep_period,
+            min_period=kwargs.get("min_sleep_period"),
+            max_period=kwargs.get("max_sleep_period"),
+            name=self.agent_name,
+        )
+        # set by run_cycle when more jobs remain to process than done in the cycle, or when known jobs get due
+        self.has_backlog = False
+        self.next_due_timestamp = None
+        self.stop_event = threading.Event()
+
     def set_logger(self):
-        setup_logger(self.logger, pid=self.get_pid(), colored=self.logger_format_colored, to_file=self.log_file)
+        setup_logger(self.logger, pid=self.get_pid(), colored=self.logger_format_colored, to_file=self.log_file, json_format=self.log_json)
         logging_log_level = LOG_LEVEL_MAP.get(self.log_level, logging.ERROR)
         self.logger.setLevel(logging_log_level)
 
+    def register_query(self, constraint, projection=None, key=None):
+        """
+        register the constraint and projection of the agent to the shared queue snapshot, if any
+        key distinguishes other constraints of the same agent
+        """
+        if self.queue_snapshot is not None:
+            name = self.agent_name if key is None else f"{self.agent_name}.{key}"
+            self.queue_snapshot.register(name, constraint, projection)
+
+    def query_jobs(self, schedd, constraint, projection=None, limit=-1):
+        """
+        query jobs from the shared queue snapshot if any, otherwise from the schedd
+        return iterator of JobRecord with attributes of projection, only ClusterId and ProcId by default
+        """
+        if projection is None:
+            projection = MINIMAL_PROJECTION
+        if self.queue_snapshot is not None:
+            return iter_job_records(self.queue_snapshot.query(schedd, constraint, limit=limit, priority=self.schedd_priority), projection)
+        return self._stream_jobs(schedd, constraint, projection, limit)
+
+    def _stream_jobs(self, schedd, constraint, projection, limit):
+        """
+        yield JobRecord of jobs from the schedd, streamed with xquery if available (htcondor version 1)
+        """
+        governor = self.schedd_pool.governor
+        if hasattr(schedd, "xquery"):
+            with governor.call(self.agent_name, "query", priority=self.schedd_priority):
+                yield from iter_job_records(schedd.xquery(constraint, projection, limit), projection)
+            return
+        with governor.call(self.agent_name, "query", priority=self.schedd_priority):
+            ad_list = schedd.query(constraint=constraint, projection=projection, limit=limit)
+        yield from iter_job_records(ad_list, projection)
+
+    @contextlib.contextmanager
+    def schedd_call(self, call, check_slow=True):
+        """
+        context manager to make other schedd calls (e.g. act) of the agent under the governor
+        the shared queue snapshot is invalidated after edit and act, even failed as they may be partially done
+        """
+        try:
+            with self.schedd_pool.governor.call(self.agent_name, call, priority=self.schedd_priority, check_slow=check_slow):
+                yield
+        finally:
+            if call in ("edit", "act") and self.queue_snapshot is not None:
+                self.queue_snapshot.invalidate()
+
+    def count_copy(self, n_bytes, method):
+        """
+        record a file copied by the agent
+        """
+        metrics.registry.inc("hgcs_copy_files_total", agent=self.agent_name, method=method)
+        metrics.registry.inc("hgcs_copy_bytes_total", n_bytes, agent=self.agent_name, method=method)
+
+    def count_dir_stat(self, dir_stat_cache):
+        """
+        record metadata syscalls avoided by the directory scans of DirStatCache of the agent in a cycle
+        """
+        metrics.registry.inc("hgcs_dir_scans_total", dir_stat_cache.n_scans, agent=self.agent_name)
+        metrics.registry.inc("hgcs_stat_calls_avoided_total", dir_stat_cache.n_avoided, agent=self.agent_name)
+        self.logger.debug(
+            f"scanned {dir_stat_cache.n_scans} directories avoiding {dir_stat_cache.n_avoided} metadata syscalls, "
+            f"{dir_stat_cache.n_direct} made anyway ; saved {dir_stat_cache.n_saved} syscalls"
+        )
+
+    def load_handled_index(self, flush_period):
+        """
+        open the persistent index of handled jobs if configured, expire jobs handled longer than flush_period ago,
+        and return ExpiringJobIdSet with ttl of flush_period and job IDs remaining in the index, expiring by their handled time
+        """
+        job_id_set = ExpiringJobIdSet(flush_period)
+        if not self.handled_index_file:
+            return job_id_set
+        try:
+            self.handled_index = HandledJobIndex(self.handled_index_file, table=re.sub(r"\W", "_", self.agent_name))
+            n_expired = self.handled_index.expire(time.time() - flush_period)
+            job_id_set.update(self.handled_index.load())
+        except sqlite3.Error as exc:
+            self.handled_index = None
+            self.logger.error(f"failed to load handled index from {self.handled_index_file} ; run without it: {exc}")
+            return job_id_set
+        self.logger.info(f"loaded {len(job_id_set)} handled jobs from {self.handled_index_file} ; expired {n_expired}")
+        return job_id_set
+
+    def expire_handled_jobs(self, job_id_set, flush_period):
+        """
+        expire handled jobs older than flush_period from the set and the persistent index
+        """
+        now = time.time()
+        n_expired = job_id_set.expire(now)
+        if n_expired:
+            self.update_handled_index(expire_before=now - flush_period)
+            self.logger.info(f"expired {n_expired} handled jobs")
+
+    def update_handled_index(self, add=None, remove=None, expire_before=None):
+        """
+        write changes of handled jobs to the persistent index, if any, in batches
+        """
+        if self.handled_index is None:
+            return
+        try:
+            if add:
+                self.handled_index.add(add)
+            if remove:
+                self.handled_index.remove(remove)
+            if expire_before is not None:
+                self.handled_index.expire(expire_before)
+        except sqlite3.Error as exc:
+            self.logger.warning(f"failed to update handled index {self.handled_index_file} : {exc}")
+
+    def discover_jobs(self, event_types):
+        """
+        in event_log discovery mode, return dict of job ID to event timestamp of jobs with events of event_types since last call
+        return None if a full reconciliation scan of the queue is needed instead, i.e. in query discovery mode,
+        at the first call, after the event log is rotated or unreadable, and every reconcile_period
+        """
+        if self.discovery_mode != "event_log":
+            return None
+        if self.event_tailer is None:
+            event_log_path = self.event_log_file or htcondor.param.get("EVENT_LOG")
+            if not event_log_path:
+                self.logger.error("no event log file configured nor EVENT_LOG of condor; fall back to query discovery mode")
+                self.discovery_mode = "query"
+                return None
+            self.event_tailer = JobEventTailer(event_log_path, event_types)
+        try:
+            job_id_dict, reopened = self.event_tailer.poll()
+        except (OSError, RuntimeError, htcondor.HTCondorException) as exc:
+            self.logger.warning(f"failed to read event log {self.event_tailer.event_log_path} ; do full scan: {exc}")
+            self.event_tailer.close()
+            return None
+        now = time.time()
+        if reopened or now >= self.last_reconcile_timestamp + self.reconcile_period:
+            self.last_reconcile_timestamp = now
+            self.logger.debug("full reconciliation scan")
+            return None
+        self.logger.debug(f"discovered {len(job_id_dict)} jobs from event log")
+        return job_id_dict
+
     def get_pid(self):
         """
         get unique thread identifier including process ID (from OS) and thread ID (from python)
         """
         return f"{self.os_pid}-{get_ident()}"
 
-    def run(self):
+    def get_schedd(self):
         """
-        run the agent
+        get the schedd, with retries; return None if no more retry
         """
-        pass
+        n_try = 999
+        for i_try in range(1, n_try + 1):
+            try:
+                return self.schedd_pool.get()
+            except (RuntimeError, htcondor.HTCondorException) as exc:
+                if i_try < n_try:
+                    # jittered exponential backoff not to retry in step with other agents
+                    backoff = min(3 * 2 ** min(i_try - 1, 10), 300) * random.uniform(0.5, 1.0)
+                    self.logger.warning(f"{exc} . Retry in {backoff:.0f} sec...")
+                    if self.stop_event.wait(backoff):
+                        return None
+                else:
+                    self.logger.error(f"{exc} . No more retry. Exit")
+        return None
 
+    def stop(self):
+        """
+        stop the agent after the current cycle
+        """
+        self.stop_event.set()
 
-class MySchedd(htcondor.Schedd):
-    """
-    Schedd class in singleton
-    """
+    def initialize(self):
+        """
+        initialize the agent before the first cycle
+        """
+        pass
 
-    __instance = None
+    def run_cycle(self, schedd):
+        """
+        run one cycle of the agent; return number of jobs processed, and set has_backlog if more jobs remain
+        or next_due_timestamp when known jobs get due
+        """
+        return 0
 
-    def __new__(cls, *args, **kwargs):
-        if not isinstance(cls.__instance, cls):
-            cls.__instance = super(MySchedd, cls).__new__(cls, *args, **kwargs)
-        return cls.__instance
+    def run(self):
+        """
+        run the agent: initialize, then run cycles with intervals from the scheduler until stopped
+        """
+        self.set_logger()
+        self.logger.info("agent starts")
+        self.logger.debug(f"startTimestamp: {self.start_timestamp}")
+        self.initialize()
+        agent_name = self.agent_name
+        while not self.stop_event.is_set():
+            self.logger.info("run starts")
+            schedd = self.get_schedd()
+            if schedd is None:
+                return
+            self.has_backlog = False
+            self.next_due_timestamp = None
+            failed = False
+            try:
+                with metrics.registry.timer("hgcs_agent_cycle_seconds", error_name="hgcs_agent_cycle_errors_total", agent=agent_name):
+                    try:
+                        n_jobs = self.run_cycle(schedd)
+                    except ScheddUnavailableError as exc:
+                        # circuit breaker open to protect the schedd; not an error of the agent
+                        self.logger.warning(f"skipped the rest of this cycle: {exc}")
+                        failed = True
+                        n_jobs = 0
+            except (RuntimeError, htcondor.HTCondorException) as exc:
+                # keep the agent alive; retry in next cycle
+                self.logger.error(f"run failed: {exc} ; {traceback.format_exc()}")
+                failed = True
+                n_jobs = 0
+            metrics.registry.inc("hgcs_agent_cycles_total", agent=agent_name)
+            metrics.registry.set("hgcs_agent_cycle_jobs", n_jobs or 0, agent=agent_name)
+            metrics.registry.set("hgcs_agent_last_cycle_timestamp_seconds", time.time(), agent=agent_name)
+            due_in = None if self.next_due_timestamp is None else self.next_due_timestamp - time.time()
+            interval = self.scheduler.next_interval(n_jobs, backlog=self.has_backlog, due_in=due_in, failed=failed)
+            self.logger.debug(f"next cycle in {interval} sec")
+            self.stop_event.wait(interval)
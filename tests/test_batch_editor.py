@@ -0,0 +1,20 @@
+"""
+tests of BatchEditor
+"""
+
+from hgcs import utils
+from hgcs.fake_schedd import FakeSchedd, generate_jobs
+
+
+def test_bad_job_ids_at_head_of_large_chunk():
+    schedd = FakeSchedd(generate_jobs(20000, start_cluster_id=100), strict=True)
+    governor = utils.ScheddGovernor(rate=float("inf"), burst=float("inf"))
+    editor = utils.BatchEditor(governor=governor, initial_chunk_size=20000)
+    # jobs gone from the queue, sorted at the head of the chunk
+    bad_id_list = ["1.0", "1.1", "1.2"]
+    good_id_list = [f"{100 + i_job // 100}.{i_job % 100}" for i_job in range(20000)]
+    succeeded_list, failed_list = editor.edit(schedd, bad_id_list + good_id_list, "hgcsTest", "true")
+    assert sorted(failed_list) == bad_id_list
+    assert sorted(succeeded_list) == sorted(good_id_list)
+    # failures due to bad job IDs do not trip the circuit breaker
+    assert governor.n_opens == 0
@@ -0,0 +1,141 @@
+"""
+tests of LogRetriever
+"""
+
+import threading
+
+from hgcs import agents, metrics, utils
+from hgcs.fake_schedd import FakeSchedd, generate_jobs
+
+
+class RecordingSchedd(FakeSchedd):
+    """
+    fake schedd recording threads calling retrieve on it
+    """
+
+    def __init__(self, *args, **kwargs):
+        FakeSchedd.__init__(self, *args, **kwargs)
+        self.retrieve_thread_set = set()
+
+    def retrieve(self, job_spec):
+        self.retrieve_thread_set.add(threading.get_ident())
+        return FakeSchedd.retrieve(self, job_spec)
+
+
+def test_condor_retrieve_uses_handle_per_worker(tmp_path):
+    job_list = generate_jobs(400, base_dir=str(tmp_path), sdf=False, file_size=10)
+    handle_list = []
+    lock = threading.Lock()
+
+    def schedd_factory():
+        # handles sharing the jobs, one per thread
+        schedd = RecordingSchedd()
+        schedd.job_dict = agent_schedd.job_dict
+        schedd.name_map = agent_schedd.name_map
+        with lock:
+            handle_list.append(schedd)
+        return schedd
+
+    agent_schedd = RecordingSchedd(job_list)
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=schedd_factory, governor=governor)
+    agent = agents.LogRetriever(sleep_period=0, retrieve_mode="condor", max_workers=4, schedd_pool=pool)
+    agent.initialize()
+    assert agent.run_cycle(agent_schedd) == 400
+    # the handle of the agent thread is not used by workers
+    assert not agent_schedd.retrieve_thread_set
+    for schedd in handle_list:
+        assert len(schedd.retrieve_thread_set) == 1
+    assert sum(schedd.n_calls["retrieve"] for schedd in handle_list) == 4
+    assert (tmp_path / "logs" / "4" / "99.out").exists()
+
+
+def run_sync_cycles(tmp_path, queue_snapshot):
+    """
+    sync logs of running jobs, then finish the jobs and retrieve them; return number of bytes synced and appended at the end
+    """
+    schedd = FakeSchedd(generate_jobs(5, base_dir=str(tmp_path), status_list=(2,), sdf=False, file_size=100))
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    schedd_name = f"sync_{queue_snapshot is not None}"
+    agent = agents.LogRetriever(sleep_period=0, sync_running=True, schedd_name=schedd_name, schedd_pool=pool, queue_snapshot=queue_snapshot)
+    agent.initialize()
+    agent.run_cycle(schedd)
+    for path in (tmp_path / "spool" / "1").iterdir():
+        with open(path, "ab") as _f:
+            _f.write(b"tail")
+    schedd.edit("JobStatus == 2", "JobStatus", "4")
+    if queue_snapshot is not None:
+        # jobs finished outside the agents are only seen at the next refresh
+        queue_snapshot.invalidate()
+    assert agent.run_cycle(schedd) == 5
+    for path in (tmp_path / "spool" / "1").iterdir():
+        assert (tmp_path / "logs" / "1" / path.name).read_bytes() == path.read_bytes()
+    return (
+        metrics.registry.get("hgcs_copy_bytes_total", agent=agent.agent_name, method="sync"),
+        metrics.registry.get("hgcs_copy_bytes_total", agent=agent.agent_name, method="append"),
+    )
+
+
+def test_sync_running_jobs(tmp_path):
+    assert run_sync_cycles(tmp_path, None) == (1500, 60)
+
+
+def test_sync_running_jobs_with_queue_snapshot(tmp_path):
+    assert run_sync_cycles(tmp_path, utils.QueueSnapshot(period=3600)) == (1500, 60)
+
+
+def test_queue_snapshot_reflects_own_edits(tmp_path):
+    schedd = FakeSchedd(generate_jobs(100, base_dir=str(tmp_path), sdf=False, file_size=10))
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    queue_snapshot = utils.QueueSnapshot(period=3600)
+    agent = agents.LogRetriever(sleep_period=0, schedd_name="own_edits", schedd_pool=pool, queue_snapshot=queue_snapshot)
+    method_list = []
+    agent.count_copy = lambda n_bytes, method: method_list.append(method)
+    agent.initialize()
+    assert agent.run_cycle(schedd) == 100
+    for _ in range(2):
+        agent.run_cycle(schedd)
+    # jobs marked retrieved are not copied again within the snapshot period
+    assert len(method_list) == 300
+
+
+def test_jobs_gone_before_marked_are_dropped(tmp_path):
+    schedd = FakeSchedd(generate_jobs(10, base_dir=str(tmp_path), sdf=False, file_size=10), strict=True)
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    agent = agents.LogRetriever(sleep_period=0, schedd_name="gone", schedd_pool=pool)
+    agent.initialize()
+    # handled in a previous cycle but failed to mark, then removed from the queue
+    agent.already_handled_job_id_set.update(["1.10", "1.11"])
+    assert agent.run_cycle(schedd) == 10
+    assert not agent.already_handled_job_id_set
+    assert schedd.job_dict["1.0"]["hgcslogretrieved"] is True
+
+
+def test_hardlink_replaces_partial_destination(tmp_path):
+    schedd = FakeSchedd(generate_jobs(2, base_dir=str(tmp_path), sdf=False, file_size=100))
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    agent = agents.LogRetriever(sleep_period=0, retrieve_mode="hardlink", schedd_name="hardlink", schedd_pool=pool)
+    agent.initialize()
+    # left by an interrupted copy
+    (tmp_path / "logs" / "1" / "0.out").write_bytes(b"partial")
+    assert agent.run_cycle(schedd) == 2
+    for name in ("0.out", "0.err", "1.out"):
+        assert (tmp_path / "logs" / "1" / name).stat().st_ino == (tmp_path / "spool" / "1" / name).stat().st_ino
+    assert sorted(path.name for path in (tmp_path / "logs" / "1").iterdir()) == ["0.err", "0.log", "0.out", "1.err", "1.log", "1.out"]
+
+
+def test_compression_recorded_on_job_ads(tmp_path):
+    schedd = FakeSchedd(generate_jobs(2, base_dir=str(tmp_path), sdf=False, file_size=100))
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    agent = agents.LogRetriever(sleep_period=0, compress="gzip", schedd_name="compress", schedd_pool=pool)
+    agent.initialize()
+    assert agent.run_cycle(schedd) == 2
+    assert (tmp_path / "logs" / "1" / "0.out.gz").exists()
+    for ad in schedd.job_dict.values():
+        assert ad["hgcslogcompression"] == "gzip"
+        assert ad["leavejobinqueue"] is False
@@ -0,0 +1,37 @@
+"""
+tests of SDFFetcher
+"""
+
+import shutil
+
+from hgcs import agents, utils
+from hgcs.fake_schedd import FakeSchedd, generate_jobs
+
+
+def test_pages_over_unordered_queue(tmp_path):
+    # jobs returned in descending order, and jobs of the first cluster failing to copy for lack of log directory
+    schedd = FakeSchedd(list(reversed(generate_jobs(2000, base_dir=str(tmp_path)))))
+    shutil.rmtree(tmp_path / "logs" / "1")
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    agent = agents.SDFFetcher(sleep_period=0, limit=100, schedd_name="unordered", schedd_pool=pool)
+    agent.set_logger = lambda: None
+    agent.initialize()
+    for _ in range(30):
+        agent.run_cycle(schedd)
+    copied_job_id_set = {job_id for job_id, ad in schedd.job_dict.items() if ad.get("sdfcopied") == 1}
+    assert len(copied_job_id_set) == 1900
+    assert not any(job_id.startswith("1.") for job_id in copied_job_id_set)
+
+
+def test_no_backlog_without_progress(tmp_path):
+    schedd = FakeSchedd(generate_jobs(200, base_dir=str(tmp_path)))
+    shutil.rmtree(tmp_path / "logs")
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    pool = utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+    agent = agents.SDFFetcher(sleep_period=0, limit=100, schedd_name="no_progress", schedd_pool=pool)
+    agent.set_logger = lambda: None
+    agent.initialize()
+    agent.has_backlog = False
+    assert agent.run_cycle(schedd) == 0
+    assert not agent.has_backlog
@@ -0,0 +1,140 @@
+"""
+tests of the run loop of agents
+"""
+
+import threading
+
+from hgcs import agents, metrics, utils
+from hgcs.fake_schedd import FakeSchedd, generate_jobs
+
+
+def make_schedd_pool(schedd):
+    """
+    make a schedd pool handing out the schedd, with a governor not limiting calls
+    """
+    governor = utils.ScheddGovernor(max_concurrency=64, rate=float("inf"), burst=float("inf"))
+    return utils.ScheddPool(schedd_factory=lambda: schedd, governor=governor)
+
+
+class FlakyAgent(utils.ThreadBase):
+    """
+    agent failing in its first cycles, then stopping itself after a successful cycle
+    """
+
+    def __init__(self, error_list, **kwargs):
+        utils.ThreadBase.__init__(self, **kwargs)
+        self.error_list = list(error_list)
+        self.n_cycles = 0
+        self.succeeded_event = threading.Event()
+
+    def set_logger(self):
+        pass
+
+    def run_cycle(self, schedd):
+        self.n_cycles += 1
+        if self.error_list:
+            raise self.error_list.pop(0)
+        self.succeeded_event.set()
+        self.stop()
+        return 0
+
+
+class FailingQuerySchedd(FakeSchedd):
+    """
+    fake schedd whose queries fail n_failures times
+    """
+
+    def __init__(self, n_failures, *args, **kwargs):
+        FakeSchedd.__init__(self, *args, **kwargs)
+        self.n_failures = n_failures
+
+    def _maybe_fail(self):
+        if self.n_failures > 0:
+            self.n_failures -= 1
+            raise utils.htcondor.HTCondorException("schedd query failed")
+
+    def query(self, *args, **kwargs):
+        self._maybe_fail()
+        return FakeSchedd.query(self, *args, **kwargs)
+
+    def xquery(self, *args, **kwargs):
+        self._maybe_fail()
+        return FakeSchedd.xquery(self, *args, **kwargs)
+
+
+def test_failed_cycles_do_not_stop_agent():
+    schedd = FakeSchedd()
+    agent = FlakyAgent(
+        [RuntimeError("boom"), utils.htcondor.HTCondorException("condor boom")],
+        sleep_period=0.01,
+        schedd_name="flaky",
+        schedd_pool=make_schedd_pool(schedd),
+    )
+    agent.start()
+    assert agent.succeeded_event.wait(10)
+    agent.join(10)
+    assert agent.n_cycles == 3
+    assert metrics.registry.get("hgcs_agent_cycle_errors_total", agent=agent.agent_name) == 2
+    assert metrics.registry.get("hgcs_agent_cycles_total", agent=agent.agent_name) == 3
+
+
+def test_log_retriever_survives_failed_query(tmp_path):
+    schedd = FailingQuerySchedd(1, generate_jobs(10, base_dir=str(tmp_path), sdf=False, file_size=10))
+    agent = agents.LogRetriever(sleep_period=0.01, schedd_name="failing_query", schedd_pool=make_schedd_pool(schedd))
+    agent.set_logger = lambda: None
+    agent.start()
+    try:
+        for _ in range(1000):
+            if (metrics.registry.get("hgcs_agent_cycles_total", agent=agent.agent_name) or 0) >= 2:
+                break
+            agent.stop_event.wait(0.01)
+        assert agent.is_alive()
+    finally:
+        agent.stop()
+        agent.join(10)
+    assert metrics.registry.get("hgcs_agent_cycle_errors_total", agent=agent.agent_name) == 1
+    assert metrics.registry.get("hgcs_agent_cycles_total", agent=agent.agent_name) >= 2
+    assert (tmp_path / "logs" / "1" / "0.out").exists()
+
+
+def test_open_circuit_skips_cycle():
+    schedd = FakeSchedd()
+    agent = FlakyAgent([utils.ScheddUnavailableError("circuit open")], sleep_period=0.01, schedd_name="circuit_open", schedd_pool=make_schedd_pool(schedd))
+    agent.start()
+    assert agent.succeeded_event.wait(10)
+    agent.join(10)
+    assert agent.n_cycles == 2
+    assert metrics.registry.get("hgcs_agent_cycle_errors_total", agent=agent.agent_name) is None
+
+
+def test_slow_calls_do_not_open_circuit_by_default():
+    governor = utils.ScheddGovernor(failure_threshold=1, rate=float("inf"), burst=float("inf"))
+    governor.acquire()
+    governor.release(True, 3600)
+    assert not governor._is_half_open()
+    governor.configure(slow_call_threshold=60)
+    governor.acquire()
+    governor.release(True, 3600)
+    assert governor._is_half_open()
+
+
+def test_long_calls_leave_slot_for_other_calls():
+    governor = utils.ScheddGovernor(max_concurrency=2, rate=float("inf"), burst=float("inf"))
+    governor.acquire(long_call=True)
+    acquired_event = threading.Event()
+
+    def acquire_long():
+        governor.acquire(long_call=True)
+        acquired_event.set()
+
+    thread = threading.Thread(target=acquire_long)
+    thread.start()
+    # the second long call waits while another call takes the free slot
+    assert not acquired_event.wait(0.2)
+    assert governor.acquire(priority=utils.PRIORITY_BULK) < 1
+    governor.release(True, 0)
+    governor.release(True, 0, check_slow=False)
+    assert acquired_event.wait(10)
+    thread.join(10)
+    governor.release(True, 0, check_slow=False)
+    assert governor.n_active == governor.n_active_long == 0